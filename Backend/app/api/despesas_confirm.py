@@ -11,7 +11,7 @@ from app.models import (
     Usuario, Despesa, DotacaoGlobal, DotacaoGlobalMov, 
     TipoDotacaoGlobalMov, StatusDespesa
 )
-from app.schemas import DespesaResponse
+from app.schemas import DespesaResponse, DespesaConfirmBatchRequest
 from app.crud import recalculate_execucao_mensal
 
 router = APIRouter()
@@ -155,3 +155,158 @@ async def confirm_despesa_with_dotacao(
         "reservado": dotacao.reservado
     }
 
+
+
+@router.post("/confirm-batch", response_model=dict)
+async def confirm_despesas_batch_with_dotacao(
+    data: DespesaConfirmBatchRequest,
+    current_user: Usuario = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Confirma várias despesas numa única transação, com validação de dotação global.
+    
+    Segue a mesma lógica de /{despesa_id}/confirm, mas os movimentos de auditoria
+    são acumulados como dicionários e inseridos de uma só vez no fim do lote, e a
+    execução mensal é atualizada em lote por confirm_despesas_bulk.
+    Despesas já confirmadas são ignoradas.
+    """
+    despesa_ids = list(dict.fromkeys(data.despesa_ids))
+    
+    # Sem db.begin(): get_current_user já consultou esta mesma sessão (autobegin).
+    # Tudo numa só transação: qualquer erro (incl. HTTPException) desfaz o lote.
+    try:
+        despesas = db.query(Despesa).filter(Despesa.id.in_(despesa_ids)).all()
+        
+        encontrados = {d.id for d in despesas}
+        nao_encontrados = [d_id for d_id in despesa_ids if d_id not in encontrados]
+        if nao_encontrados:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Despesas não encontradas: {nao_encontrados}"
+            )
+        
+        canceladas = [d.id for d in despesas if d.status == StatusDespesa.CANCELADA]
+        if canceladas:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Não é possível confirmar despesas canceladas: {canceladas}"
+            )
+        
+        pendentes = [d for d in despesas if d.status != StatusDespesa.CONFIRMADA]
+        
+        if data.override:
+            from app.models import UsuarioPapel, Papel
+            is_admin = db.query(UsuarioPapel).join(Papel).filter(
+                and_(
+                    UsuarioPapel.usuario_id == current_user.id,
+                    Papel.nome == "admin"
+                )
+            ).first()
+            
+            if not is_admin:
+                raise HTTPException(
+                    status_code=403,
+                    detail="Apenas administradores podem usar override"
+                )
+        
+        # Agrupar por exercício (uma dotação global por exercício)
+        por_exercicio = {}
+        for despesa in pendentes:
+            por_exercicio.setdefault(despesa.exercicio, []).append(despesa)
+        
+        # Lock das dotações envolvidas (SELECT FOR UPDATE)
+        dotacoes = {
+            d.exercicio: d
+            for d in db.query(DotacaoGlobal).filter(
+                DotacaoGlobal.exercicio.in_(list(por_exercicio.keys()))
+            ).with_for_update().all()
+        } if por_exercicio else {}
+        
+        movimentos = []
+        for exercicio, despesas_exercicio in por_exercicio.items():
+            dotacao = dotacoes.get(exercicio)
+            if not dotacao:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Dotacao global para exercício {exercicio} não encontrada. "
+                           f"Crie a dotação global antes de confirmar despesas."
+                )
+            
+            total = sum((d.valor for d in despesas_exercicio), Decimal("0.00"))
+            saldo_disponivel = dotacao.saldo - dotacao.reservado
+            
+            if not data.override and total > saldo_disponivel:
+                raise HTTPException(
+                    status_code=400,
+                    detail=(
+                        f"Saldo insuficiente na dotação global de {exercicio}. "
+                        f"Disponível: {saldo_disponivel}, "
+                        f"Necessário: {total}. "
+                        f"Use override=true para forçar (apenas admin)."
+                    )
+                )
+            
+            dotacao.saldo = dotacao.saldo - total
+            
+            for despesa in despesas_exercicio:
+                movimentos.append({
+                    "dotacao_global_id": dotacao.id,
+                    "tipo": TipoDotacaoGlobalMov.DESPESA_CONFIRMADA.value,
+                    "referencia": str(despesa.id),
+                    "valor": -despesa.valor,
+                    "descricao": f"Despesa #{despesa.id} confirmada: {despesa.valor}",
+                    "usuario_id": current_user.id
+                })
+        
+        # Movimentos de auditoria num único INSERT (sem unit-of-work por linha)
+        if movimentos:
+            db.bulk_insert_mappings(DotacaoGlobalMov, movimentos)
+        
+        # Sem rubrica: só muda o estado (não há execução mensal a atualizar)
+        com_rubrica = []
+        for despesa in pendentes:
+            if despesa.rubrica_id:
+                com_rubrica.append(despesa.id)
+            else:
+                despesa.status = StatusDespesa.CONFIRMADA
+        
+        # Estado + execução mensal do lote (rubricas e ancestrais) na mesma transação
+        # que o débito da dotação: uma falha desfaz tudo
+        if com_rubrica:
+            from app.services.despesa_service import confirm_despesas_bulk
+            confirm_despesas_bulk(db, com_rubrica, commit=False)
+            
+            from app.services.rubrica_service import recalculate_dotacao_chain
+            for rubrica_id in {d.rubrica_id for d in pendentes if d.rubrica_id}:
+                recalculate_dotacao_chain(db, rubrica_id)
+        
+        # Dados dos eventos lidos antes do commit (que expira os objetos)
+        eventos = [
+            (d.exercicio, {
+                "despesa_id": d.id,
+                "valor": float(d.valor),
+                "rubrica_id": d.rubrica_id
+            })
+            for d in pendentes
+        ]
+        
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    
+    # Notificar evento SSE (só depois do commit)
+    from app.api.dashboard_events import notify_event_sync
+    for exercicio, payload in eventos:
+        notify_event_sync(exercicio, "despesa_confirmada", payload)
+    
+    return {
+        "message": f"{len(pendentes)} despesa(s) confirmada(s) com sucesso",
+        "confirmadas": [d.id for d in pendentes],
+        "ja_confirmadas": [d.id for d in despesas if d not in pendentes],
+        "saldo_restante": {
+            exercicio: dotacao.saldo - dotacao.reservado
+            for exercicio, dotacao in dotacoes.items()
+        }
+    }
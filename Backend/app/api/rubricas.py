@@ -5,7 +5,7 @@ from typing import Optional, List
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, func, text
-from app.db import get_db
+from app.db import get_db, supports_recursive_cte
 from app.api.auth import get_current_user, require_admin
 from app.models import Usuario, Rubrica, Despesa, StatusDespesa, StatusRubrica
 from app.schemas import (
@@ -136,20 +136,16 @@ async def list_rubricas_flat(
     # Recalcular se necessário (apenas para rubricas do mesmo exercício)
     # IMPORTANTE: Não bloquear o retorno das rubricas se houver erro no recálculo
     try:
-        from app.services.rubrica_service import recalculate_dotacao_chain
+        from app.services.rubrica_service import recalculate_dotacao_exercicio
         if exercicio and all_rubricas_exercicio:
-            # Recalcular para TODAS as rubricas do exercício
-            # Processar do mais profundo para o mais alto (folhas primeiro, depois pais)
-            # Ordenar por nível descendente (maior nível primeiro)
-            rubricas_ordenadas = sorted(all_rubricas_exercicio, key=lambda r: r.nivel, reverse=True)
-            
-            for rubrica in rubricas_ordenadas:
-                try:
-                    recalculate_dotacao_chain(db, rubrica.id)
-                except Exception as e:
-                    # Log do erro mas continua
-                    import logging
-                    logging.warning(f"Erro ao recalcular dotação para rubrica {rubrica.id}: {e}")
+            # Recalcular para TODAS as rubricas do exercício numa única passagem
+            # (do mais profundo para o mais alto: folhas primeiro, depois pais)
+            try:
+                recalculate_dotacao_exercicio(db, exercicio)
+            except Exception as e:
+                # Log do erro mas continua
+                import logging
+                logging.warning(f"Erro ao recalcular dotação do exercício {exercicio}: {e}")
             try:
                 db.commit()
             except Exception as e:
@@ -306,20 +302,21 @@ async def get_rubricas_tree(
     
     # Garantir que dotacao_calculada está atualizada para todas as rubricas
     # Recalcular do mais profundo para o mais alto (folhas primeiro, depois pais)
-    from app.services.rubrica_service import recalculate_dotacao_chain
+    from app.services.rubrica_service import recalculate_dotacao_exercicio
     if all_rubricas:
-        rubricas_ordenadas = sorted(all_rubricas, key=lambda r: r.nivel, reverse=True)
-        for rubrica in rubricas_ordenadas:
-            try:
-                recalculate_dotacao_chain(db, rubrica.id)
-            except Exception as e:
-                import logging
-                logging.warning(f"Erro ao recalcular dotação para rubrica {rubrica.id}: {e}")
+        try:
+            recalculate_dotacao_exercicio(db, exercicio)
+        except Exception as e:
+            import logging
+            logging.warning(f"Erro ao recalcular dotação do exercício {exercicio}: {e}")
         db.commit()
     
     # Criar dicionário por ID para acesso rápido
     rubricas_dict = {r.id: r for r in all_rubricas}
     
+    # Gasto total (Decimal exato) de cada nó já construído, somado pelo pai
+    gasto_total_por_id = {}
+    
     # Construir árvore recursivamente
     def build_tree_node(rubrica_id: int) -> Optional[dict]:
         rubrica = rubricas_dict.get(rubrica_id)
@@ -364,11 +361,12 @@ async def get_rubricas_tree(
             child_node = build_tree_node(child.id)
             if child_node:
                 node["children"].append(child_node)
-                # Somar gasto dos filhos
-                gasto_filhos += Decimal(str(child_node.get("gasto", 0)))
+                # Somar gasto dos filhos (sem ida e volta float -> str -> Decimal)
+                gasto_filhos += gasto_total_por_id[child.id]
         
         # Gasto total = gasto direto + gasto dos filhos
         gasto_total = gasto_direto + gasto_filhos
+        gasto_total_por_id[rubrica_id] = gasto_total
         node["gasto"] = float(gasto_total)
         node["saldo"] = float(dotacao_valor - gasto_total)
         
@@ -429,7 +427,7 @@ async def get_rubrica_despesas(
         ORDER BY d.data_emissao DESC, d.id DESC
     """)
     
-    try:
+    if supports_recursive_cte(db.get_bind()):
         result = db.execute(query, {"rubrica_id": rubrica.id, "exercicio": exercicio})
         despesas = []
         for row in result:
@@ -448,27 +446,27 @@ async def get_rubrica_despesas(
                     "requisicao": despesa.requisicao
                 })
         return despesas
-    except Exception as e:
-        # Fallback: busca simples sem CTE (para MySQL < 8)
-        despesas = db.query(Despesa).filter(
-            and_(
-                Despesa.rubrica_id == rubrica.id,
-                Despesa.exercicio == exercicio
-            )
-        ).all()
-        
-        return [{
-            "id": d.id,
-            "rubrica_id": d.rubrica_id,
-            "fornecedor_id": d.fornecedor_id,
-            "fornecedor_text": d.fornecedor_text,
-            "valor": float(d.valor),
-            "data_emissao": d.data_emissao.isoformat() if d.data_emissao else None,
-            "mes": d.mes,
-            "status": d.status.value,
-            "ordem_pagamento": d.ordem_pagamento,
-            "requisicao": d.requisicao
-        } for d in despesas]
+    
+    # Fallback: busca simples sem CTE (para MySQL < 8)
+    despesas = db.query(Despesa).filter(
+        and_(
+            Despesa.rubrica_id == rubrica.id,
+            Despesa.exercicio == exercicio
+        )
+    ).all()
+    
+    return [{
+        "id": d.id,
+        "rubrica_id": d.rubrica_id,
+        "fornecedor_id": d.fornecedor_id,
+        "fornecedor_text": d.fornecedor_text,
+        "valor": float(d.valor),
+        "data_emissao": d.data_emissao.isoformat() if d.data_emissao else None,
+        "mes": d.mes,
+        "status": d.status.value,
+        "ordem_pagamento": d.ordem_pagamento,
+        "requisicao": d.requisicao
+    } for d in despesas]
 
 
 @router.get("/balancete", response_model=BalanceteResponse)
@@ -834,7 +832,7 @@ async def popular_execucao_mensal(
     Útil para popular dados históricos ou corrigir inconsistências.
     """
     from app.models import ExecucaoMensal, StatusDespesa, StatusRubrica
-    from app.services.rubrica_service import recalculate_dotacao_chain
+    from app.services.rubrica_service import recalculate_dotacao_exercicio
     from app.crud import recalculate_execucao_mensal
     
     # Primeiro, garantir que dotacao_calculada está atualizada para todas as rubricas
@@ -852,13 +850,11 @@ async def popular_execucao_mensal(
         }
     
     # Recalcular dotacao_calculada para todas as rubricas (do mais profundo para o mais alto)
-    rubricas_ordenadas = sorted(rubricas, key=lambda r: r.nivel, reverse=True)
-    for rubrica in rubricas_ordenadas:
-        try:
-            recalculate_dotacao_chain(db, rubrica.id)
-        except Exception as e:
-            import logging
-            logging.warning(f"Erro ao recalcular dotação para rubrica {rubrica.id}: {e}")
+    try:
+        recalculate_dotacao_exercicio(db, exercicio)
+    except Exception as e:
+        import logging
+        logging.warning(f"Erro ao recalcular dotação do exercício {exercicio}: {e}")
     db.commit()
     
     # Buscar todas as despesas confirmadas do exercício
@@ -927,7 +923,7 @@ async def recalcular_dotacao_exercicio(
     """
     from app.models import StatusRubrica
     from sqlalchemy.orm import defer
-    from app.services.rubrica_service import recalculate_dotacao_chain
+    from app.services.rubrica_service import recalculate_dotacao_exercicio
     
     # Buscar todas as rubricas ativas do exercício
     all_rubricas = db.query(Rubrica).filter(
@@ -942,19 +938,18 @@ async def recalcular_dotacao_exercicio(
             "recalculadas": 0
         }
     
-    # Recalcular do mais profundo para o mais alto (folhas primeiro, depois pais)
-    rubricas_ordenadas = sorted(all_rubricas, key=lambda r: r.nivel, reverse=True)
+    # Recalcular do mais profundo para o mais alto (folhas primeiro, depois pais),
+    # todas as rubricas de cada nível de uma só vez
     recalculadas = 0
     erros = []
     
-    for rubrica in rubricas_ordenadas:
-        try:
-            recalculate_dotacao_chain(db, rubrica.id)
-            recalculadas += 1
-        except Exception as e:
-            erros.append(f"Rubrica {rubrica.id} ({rubrica.codigo}): {str(e)}")
-            import logging
-            logging.error(f"Erro ao recalcular dotação para rubrica {rubrica.id}: {e}")
+    try:
+        recalculate_dotacao_exercicio(db, exercicio)
+        recalculadas = len(all_rubricas)
+    except Exception as e:
+        erros.append(f"Exercício {exercicio}: {str(e)}")
+        import logging
+        logging.error(f"Erro ao recalcular dotação do exercício {exercicio}: {e}")
     
     db.commit()
     
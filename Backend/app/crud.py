@@ -10,7 +10,7 @@ from decimal import Decimal
 from app.models import (
     Usuario, Papel, Fornecedor, Funcionario, Rubrica, 
     Despesa, ExecucaoMensal, ImportBatch, UsuarioPapel,
-    StatusDespesa
+    StatusDespesa, compute_codigo_hash
 )
 from app.schemas import (
     UsuarioCreate, UsuarioUpdate, PapelCreate, 
@@ -34,9 +34,9 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
         return False
 
 
-def get_password_hash(password: str) -> str:
-    """Gera hash de senha usando bcrypt."""
-    salt = bcrypt.gensalt()
+def get_password_hash(password: str, rounds: Optional[int] = None) -> str:
+    """Gera hash de senha usando bcrypt (rounds=None usa o custo padrão do bcrypt)."""
+    salt = bcrypt.gensalt(rounds) if rounds else bcrypt.gensalt()
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -581,19 +581,16 @@ def delete_funcionario(db: Session, funcionario_id: int) -> bool:
 
 # ========== Rubrica CRUD ==========
 def get_rubrica(db: Session, rubrica_id: int) -> Optional[Rubrica]:
-    """Busca rubrica por ID."""
-    return db.query(Rubrica).filter(Rubrica.id == rubrica_id).first()
+    """Busca rubrica por ID (usa o mapa de identidade da sessão antes de ir à base)."""
+    return db.get(Rubrica, rubrica_id)
 
 
 def get_rubrica_by_codigo_exercicio(
     db: Session, codigo: str, exercicio: int
 ) -> Optional[Rubrica]:
-    """Busca rubrica por código e exercício."""
+    """Busca rubrica por código e exercício (via codigo_hash)."""
     return db.query(Rubrica).filter(
-        and_(
-            Rubrica.codigo == codigo,
-            Rubrica.exercicio == exercicio
-        )
+        Rubrica.codigo_hash == compute_codigo_hash(codigo, exercicio)
     ).first()
 
 
@@ -731,8 +728,11 @@ def list_rubricas(
 
 
 # ========== Despesa CRUD ==========
-def create_despesa(db: Session, despesa: DespesaCreate) -> Despesa:
-    """Cria nova despesa com validações."""
+def validate_despesa(db: Session, despesa: DespesaCreate) -> DespesaCreate:
+    """
+    Valida dados de uma nova despesa (sem persistir).
+    Preenche mês e exercício a partir da data quando não fornecidos.
+    """
     from app.services.despesa_service import is_rubrica_leaf
     from app.models import StatusRubrica
     
@@ -779,6 +779,13 @@ def create_despesa(db: Session, despesa: DespesaCreate) -> Despesa:
         if despesa.data_emissao.year != despesa.exercicio:
             raise ValueError(f"Data de emissão ({despesa.data_emissao.year}) deve estar dentro do exercício ({despesa.exercicio})")
     
+    return despesa
+
+
+def create_despesa(db: Session, despesa: DespesaCreate) -> Despesa:
+    """Cria nova despesa com validações."""
+    despesa = validate_despesa(db, despesa)
+    
     # Status inicial sempre pendente
     despesa_dict = despesa.model_dump()
     despesa_dict['status'] = StatusDespesa.PENDENTE
@@ -2,15 +2,35 @@
 Configuração do banco de dados com SQLAlchemy 2.x.
 """
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.config import settings
 
+_url = make_url(settings.DATABASE_URL)
+
+# Tamanho do pool: o SQLite usa pools próprios que não aceitam estes argumentos
+_engine_kwargs = {}
+if _url.get_backend_name() != "sqlite":
+    _engine_kwargs.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+    )
+
+# Opções de executemany em lote por driver (pymysql já agrupa INSERTs num só VALUES)
+if _url.get_driver_name() == "psycopg2":
+    _engine_kwargs.update(
+        executemany_mode="values_plus_batch",
+        insertmanyvalues_page_size=10000,
+        executemany_batch_page_size=1000,
+    )
+
 # Engine com pool de conexões
 engine = create_engine(
     settings.DATABASE_URL,
     pool_pre_ping=True,
     pool_recycle=3600,
-    echo=False  # Set to True para debug SQL
+    echo=False,  # Set to True para debug SQL
+    **_engine_kwargs
 )
 
 # Session factory
@@ -20,6 +40,39 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def supports_recursive_cte(bind) -> bool:
+    """
+    Indica se o servidor suporta WITH RECURSIVE (MySQL 8+ / MariaDB 10.2+, PostgreSQL, SQLite).
+    Decidido pela versão do servidor em vez de tentar a consulta e apanhar a exceção.
+    """
+    dialect = bind.dialect
+    if dialect.name in ("postgresql", "sqlite"):
+        return True
+    if dialect.name != "mysql":
+        return False
+    version = dialect.server_version_info
+    if not version:
+        # Ainda sem ligação aberta: assumir servidor atual
+        return True
+    minimo = (10, 2) if getattr(dialect, "is_mariadb", False) else (8, 0)
+    return tuple(version[:2]) >= minimo
+
+
+def supports_member_of(bind) -> bool:
+    """
+    Indica se o servidor suporta o operador MEMBER OF (MySQL 8.0.17+).
+    O MariaDB não o tem (usa-se JSON_CONTAINS, sem o índice multi-valor).
+    """
+    dialect = bind.dialect
+    if dialect.name != "mysql" or getattr(dialect, "is_mariadb", False):
+        return False
+    version = dialect.server_version_info
+    if not version:
+        # Ainda sem ligação aberta: assumir servidor atual
+        return True
+    return tuple(version[:3]) >= (8, 0, 17)
+
+
 def get_db():
     """
     Dependency para obter sessão do banco de dados.
@@ -3,13 +3,18 @@ Modelos SQLAlchemy 2.x que mapeiam o schema MySQL.
 """
 from sqlalchemy import (
     Column, Integer, String, DateTime, Date, Boolean, ForeignKey, 
-    Numeric, Text, Enum as SQLEnum, UniqueConstraint, Index, SmallInteger
+    Numeric, Text, Enum as SQLEnum, UniqueConstraint, Index, SmallInteger,
+    BINARY, JSON, event, select, text, case, cast, literal
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred, object_session
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.sql import func
-from app.db import Base
+from app.db import Base, supports_member_of
 import enum
+import hashlib
+import json
 
 
 class TipoFornecedor(str, enum.Enum):
@@ -224,12 +229,17 @@ class Rubrica(Base):
     dotacao_calculada = Column(Numeric(18, 2), nullable=True)  # DECIMAL(18,2) - calculada automaticamente
     exercicio = Column(SmallInteger, nullable=False, index=True)  # SMALLINT no SQL
     status = Column(SQLEnum(StatusRubrica), default=StatusRubrica.ATIVA, nullable=False)
+    # Hash de 8 bytes de (codigo, exercicio) para lookup com chave curta (ver compute_codigo_hash)
+    codigo_hash = Column(BINARY(8), nullable=False)
+    # Caminho materializado: ids dos ancestrais da raiz até ao pai (ver _set_rubrica_traversal_ids)
+    traversal_ids = Column(JSON, nullable=False, default=list)
     criado_em = Column(DateTime, server_default=func.now(), nullable=False)
     actualizado_em = Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
     
     # Constraints
     __table_args__ = (
         UniqueConstraint("codigo", "exercicio", name="uq_rubrica_codigo_exercicio"),
+        UniqueConstraint("codigo_hash", name="uq_rubrica_codigo_hash"),
         Index("idx_rubrica_parent", "parent_id"),
     )
     
@@ -245,6 +255,149 @@ class Rubrica(Base):
     reconciliation_issues = relationship("ReconciliationIssue", back_populates="rubrica")
 
 
+def compute_codigo_hash(codigo: str, exercicio: int) -> bytes:
+    """
+    Calcula o hash de 8 bytes de (codigo, exercicio).
+    Equivale a UNHEX(LEFT(SHA2(CONCAT(codigo, ':', exercicio), 256), 16)) no MySQL.
+    """
+    return hashlib.sha256(f"{codigo}:{exercicio}".encode("utf-8")).digest()[:8]
+
+
+@event.listens_for(Rubrica, "before_insert")
+@event.listens_for(Rubrica, "before_update")
+def _set_rubrica_codigo_hash(mapper, connection, target):
+    """Mantém codigo_hash sincronizado com codigo/exercicio."""
+    target.codigo_hash = compute_codigo_hash(target.codigo, target.exercicio)
+
+
+def traversal_contains(bind, rubrica_id: int):
+    """
+    Filtro "rubrica_id está em rubrica.traversal_ids", i.e. descendentes de rubrica_id.
+    No MySQL 8.0.17+ usa MEMBER OF; no MariaDB (alvo de scripts/, sem índice
+    multi-valor) / MySQL anterior, JSON_CONTAINS; no PostgreSQL, contenção jsonb (@>).
+    """
+    dialect_name = bind.dialect.name
+    if dialect_name == "mysql":
+        if supports_member_of(bind):
+            clause = text(":traversal_id MEMBER OF(rubrica.traversal_ids)")
+        else:
+            clause = text(
+                "JSON_CONTAINS(rubrica.traversal_ids, CAST(:traversal_id AS CHAR))"
+            )
+    elif dialect_name == "postgresql":
+        clause = text(
+            "CAST(rubrica.traversal_ids AS JSONB) @> "
+            "to_jsonb(CAST(:traversal_id AS INTEGER))"
+        )
+    elif dialect_name == "sqlite":
+        clause = text(
+            "EXISTS (SELECT 1 FROM json_each(rubrica.traversal_ids) "
+            "WHERE json_each.value = :traversal_id)"
+        )
+    else:
+        raise NotImplementedError(
+            f"traversal_contains não suporta o dialeto {dialect_name}"
+        )
+    return clause.bindparams(traversal_id=rubrica_id)
+
+
+def _rebase_traversal_ids(bind, old_len: int, novo_path):
+    """
+    Expressão SQL do novo traversal_ids de um descendente: remove os old_len
+    primeiros ids (o caminho antigo até à rubrica movida) e põe novo_path à frente.
+    """
+    column = Rubrica.__table__.c.traversal_ids
+    dialect_name = bind.dialect.name
+    if dialect_name == "mysql":
+        # JSON_REMOVE / JSON_ARRAY_INSERT avaliam os caminhos da esquerda para a direita
+        expr = func.JSON_REMOVE(column, *["$[0]"] * old_len) if old_len else column
+        if novo_path:
+            args = []
+            for i, node_id in enumerate(novo_path):
+                args += [f"$[{i}]", node_id]
+            expr = func.JSON_ARRAY_INSERT(expr, *args)
+        return expr
+    if dialect_name == "postgresql":
+        expr = cast(column, JSONB)
+        for _ in range(old_len):
+            expr = expr.op("-")(0)
+        return cast(cast(literal(json.dumps(novo_path)), JSONB).op("||")(expr), JSON)
+    if dialect_name == "sqlite":
+        # Sem inserção em posição no SQLite: o json_remove devolve JSON compacto
+        # ("[3,4]"), o prefixo é concatenado como texto
+        resto = func.json_remove(column, *["$[0]"] * old_len) if old_len else func.json(column)
+        if not novo_path:
+            return resto
+        prefixo = json.dumps(novo_path, separators=(",", ":"))[:-1]
+        return case(
+            (func.json_array_length(resto) == 0, literal(prefixo + "]")),
+            else_=literal(prefixo + ",") + func.substr(resto, 2)
+        )
+    raise NotImplementedError(
+        f"_rebase_traversal_ids não suporta o dialeto {dialect_name}"
+    )
+
+
+def _clear_tree_cache(target):
+    """A árvore mudou: descartar os caches da hierarquia da sessão do target."""
+    session = object_session(target)
+    if session is not None:
+        from app.services.rubrica_service import clear_rubrica_tree_cache
+        clear_rubrica_tree_cache(session)
+    return session
+
+
+def _parent_path(connection, parent_id):
+    """traversal_ids de um filho de parent_id: caminho do pai + o próprio pai."""
+    if not parent_id:
+        return []
+    table = Rubrica.__table__
+    path = connection.execute(
+        select(table.c.traversal_ids).where(table.c.id == parent_id)
+    ).scalar()
+    return list(path or []) + [parent_id]
+
+
+@event.listens_for(Rubrica, "before_insert")
+def _set_rubrica_traversal_ids(mapper, connection, target):
+    """Preenche traversal_ids a partir do pai."""
+    target.traversal_ids = _parent_path(connection, target.parent_id)
+    # Nova folha: o pai deixou de ser folha e os ancestrais ganharam um descendente
+    _clear_tree_cache(target)
+
+
+@event.listens_for(Rubrica, "before_update")
+def _update_rubrica_traversal_ids(mapper, connection, target):
+    """Recalcula traversal_ids quando parent_id muda, incluindo os descendentes."""
+    if not get_history(target, "parent_id").has_changes():
+        return
+    
+    table = Rubrica.__table__
+    novo_path = _parent_path(connection, target.parent_id)
+    if target.id in novo_path:
+        raise ValueError("Uma rubrica não pode ser descendente de si mesma")
+    # Caminho antigo ainda na base de dados (o UPDATE do target vem depois deste evento)
+    old_len = len(connection.execute(
+        select(table.c.traversal_ids).where(table.c.id == target.id)
+    ).scalar() or [])
+    target.traversal_ids = novo_path
+    
+    # Descendentes num único UPDATE: trocar o prefixo até target.id pelo novo caminho
+    if old_len or novo_path:
+        connection.execute(
+            table.update().where(traversal_contains(connection, target.id)).values(
+                traversal_ids=_rebase_traversal_ids(connection, old_len, novo_path)
+            )
+        )
+    
+    session = _clear_tree_cache(target)
+    if session is not None:
+        # Descendentes já carregados ficaram com o caminho antigo: recarregar no acesso
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Rubrica) and target.id in (obj.__dict__.get("traversal_ids") or []):
+                session.expire(obj, ["traversal_ids"])
+
+
 class UserCreationLog(Base):
     """Log de criação automática de usuários."""
     __tablename__ = "user_creation_log"
@@ -253,7 +406,7 @@ class UserCreationLog(Base):
     usuario_id = Column(Integer, ForeignKey("usuario.id"), nullable=True)
     tipo = Column(String(20), nullable=False)  # "fornecedor" ou "funcionario"
     ref_id = Column(Integer, nullable=False)  # ID do fornecedor ou funcionario
-    detalhes = Column(Text, nullable=True)
+    detalhes = deferred(Column(Text, nullable=True))  # Carregado apenas quando acedido
     criado_em = Column(DateTime, server_default=func.now(), nullable=False)
     
     # Relationships
@@ -272,7 +425,7 @@ class ImportBatch(Base):
     criadas = Column(Integer, default=0, nullable=False)
     atualizadas = Column(Integer, default=0, nullable=False)
     erros = Column(Integer, default=0, nullable=False)
-    detalhes = Column(Text, nullable=True)  # JSON com detalhes de erros
+    detalhes = Column(Text, nullable=True)  # JSON com detalhes de erros (devolvido por GET /import/{batch_id})
     criado_em = Column(DateTime, server_default=func.now(), nullable=False)
     
     # Relationships
@@ -300,6 +453,15 @@ class Despesa(Base):
     created_at = Column(DateTime, server_default=func.now(), nullable=False)  # created_at no SQL
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)  # updated_at no SQL
     
+    # Particionamento por exercício (MySQL) só na migração
+    # scripts/partition_despesa_exercicio.sql: a tabela particionada exige PK com
+    # exercicio e não admite FKs, o que o modelo (id como PK, FKs) não declara.
+    __table_args__ = (
+        # Despesas confirmadas do exercício agrupadas por (rubrica, mês): scripts de
+        # execução mensal e agregados. Ver scripts/add_despesa_exercicio_status_index.sql
+        Index("idx_despesa_exercicio_status", "exercicio", "status", "rubrica_id", "mes"),
+    )
+    
     # Relationships
     rubrica = relationship("Rubrica", back_populates="despesas")
     fornecedor = relationship("Fornecedor", back_populates="despesas")
@@ -336,13 +498,19 @@ class ReconciliationIssue(Base):
     id = Column(Integer, primary_key=True, index=True)
     rubrica_id = Column(Integer, ForeignKey("rubrica.id"), nullable=False, index=True)
     tipo = Column(SQLEnum(TipoReconciliationIssue), nullable=False)
-    descricao = Column(Text, nullable=False)
+    descricao = deferred(Column(Text, nullable=False))  # Carregado apenas quando acedido
     valor_diferenca = Column(Numeric(18, 2), nullable=True)  # DECIMAL(18,2) no SQL
     criado_em = Column(DateTime, server_default=func.now(), nullable=False)
-    resolvido = Column(Boolean, default=False, nullable=False, index=True)
+    resolvido = Column(Boolean, default=False, nullable=False)
     resolvido_em = Column(DateTime, nullable=True)
     resolvido_por = Column(Integer, ForeignKey("usuario.id"), nullable=True)
     
+    # Constraints
+    # Sem índice isolado em resolvido (booleano): serve "pendentes por rubrica"
+    __table_args__ = (
+        Index("idx_recon_unresolved", "rubrica_id", "resolvido"),
+    )
+    
     # Relationships
     rubrica = relationship("Rubrica", back_populates="reconciliation_issues")
 
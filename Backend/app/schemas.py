@@ -330,6 +330,12 @@ class DespesaUpdate(BaseModel):
     mes: Optional[int] = Field(None, ge=1, le=12)
 
 
+class DespesaConfirmBatchRequest(BaseModel):
+    """Schema para confirmação de várias despesas numa única transação."""
+    despesa_ids: List[int] = Field(..., min_length=1)
+    override: bool = False  # Permitir confirmação sem saldo (apenas admin)
+
+
 class DespesaResponse(DespesaBase):
     """Schema de resposta de despesa."""
     id: int
@@ -2,18 +2,42 @@
 Serviço para gerenciar confirmação de despesas e atualização de execução mensal.
 """
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
-from typing import List
+from sqlalchemy import and_, func, text
+from typing import List, Dict, Tuple, Optional
 from decimal import Decimal
+from collections import defaultdict
 from datetime import date
 from app.models import Despesa, ExecucaoMensal, Rubrica, StatusDespesa
-from app.services.rubrica_service import get_ancestors, get_children
+from app.services.rubrica_service import get_ancestors, is_leaf_rubrica
+
+# Instrução SQL (MySQL) construída uma vez, reutilizada em cada confirmação
+_UPSERT_EXECUCAO_SQL = text("""
+    INSERT INTO execucao_mensal (rubrica_id, mes, ano, dotacao, gasto, saldo)
+    SELECT
+        r.id, :mes, :ano,
+        COALESCE(r.dotacao_calculada, 0),
+        COALESCE(s.gasto, 0),
+        COALESCE(r.dotacao_calculada, 0) - COALESCE(s.gasto, 0)
+    FROM rubrica r
+    LEFT JOIN (
+        SELECT rubrica_id, SUM(valor) AS gasto
+        FROM despesa
+        WHERE rubrica_id = :rubrica_id
+            AND mes = :mes
+            AND exercicio = :ano
+            AND status = :status
+        GROUP BY rubrica_id
+    ) s ON s.rubrica_id = r.id
+    WHERE r.id = :rubrica_id
+    ON DUPLICATE KEY UPDATE
+        gasto = VALUES(gasto),
+        saldo = execucao_mensal.dotacao - VALUES(gasto)
+""")
 
 
 def is_rubrica_leaf(db: Session, rubrica_id: int) -> bool:
-    """Verifica se rubrica é folha (não tem filhos)."""
-    from app.services.rubrica_service import has_children
-    return not has_children(db, rubrica_id)
+    """Verifica se rubrica é folha (não tem filhos); EXISTS memoizado por sessão."""
+    return is_leaf_rubrica(db, rubrica_id)
 
 
 def update_execucao_mensal(
@@ -21,13 +45,28 @@ def update_execucao_mensal(
     rubrica_id: int, 
     mes: int, 
     ano: int
-) -> ExecucaoMensal:
+) -> Optional[ExecucaoMensal]:
     """
     Atualiza ou cria execução mensal para uma rubrica.
     Calcula gasto total de despesas confirmadas e atualiza saldo.
+    
+    Em MySQL é feito num único INSERT ... ON DUPLICATE KEY UPDATE (retorna None).
     """
+    if db.get_bind().dialect.name == "mysql":
+        db.flush()
+        result = db.execute(_UPSERT_EXECUCAO_SQL, {
+            "rubrica_id": rubrica_id,
+            "mes": mes,
+            "ano": ano,
+            "status": StatusDespesa.CONFIRMADA.name
+        })
+        if result.rowcount == 0:
+            raise ValueError(f"Rubrica {rubrica_id} não encontrada")
+        return None
+    
+    # Fallback ORM (ex: SQLite nos testes)
     # Buscar rubrica
-    rubrica = db.query(Rubrica).filter(Rubrica.id == rubrica_id).first()
+    rubrica = db.get(Rubrica, rubrica_id)
     if not rubrica:
         raise ValueError(f"Rubrica {rubrica_id} não encontrada")
     
@@ -67,7 +106,7 @@ def update_execucao_mensal(
         execucao.gasto = gasto_total
         execucao.saldo = execucao.dotacao - gasto_total
     
-    db.flush()
+    # Sem flush aqui: o chamador grava tudo de uma vez (ver confirm_despesa_with_execucao)
     return execucao
 
 
@@ -79,72 +118,127 @@ def update_ancestors_execucao_mensal(
 ) -> None:
     """
     Atualiza execução mensal de todas as rubricas ancestrais recursivamente.
-    Para cada ancestral, soma os gastos de todos os filhos.
+    Para cada ancestral, gasto = gasto já gravado dos filhos diretos + despesas
+    confirmadas diretamente nele. Só a cadeia de ancestrais é lida (nunca a
+    subárvore inteira de cada um), com um número fixo de consultas e um upsert.
     """
-    # Obter ancestrais (incluindo a própria rubrica)
-    ancestors = get_ancestors(db, rubrica_id)
+    db.flush()
+    # Obter ancestrais (incluindo a própria rubrica), do mais profundo ao mais
+    # superficial, seguindo parent_id a partir da própria rubrica
+    by_id = {a.id: a for a in get_ancestors(db, rubrica_id)}
+    ancestors = []
+    node = by_id.get(rubrica_id)
+    while node is not None and node not in ancestors:
+        ancestors.append(node)
+        node = by_id.get(node.parent_id)
+    ancestor_ids = [a.id for a in ancestors]
+    if not ancestor_ids:
+        return
+    
+    # Filhos diretos de todos os ancestrais (uma consulta)
+    children_of: Dict[int, List[int]] = defaultdict(list)
+    for child_id, parent_id in db.query(Rubrica.id, Rubrica.parent_id).filter(
+        Rubrica.parent_id.in_(ancestor_ids)
+    ).all():
+        children_of[parent_id].append(child_id)
+    child_ids = {c for ids in children_of.values() for c in ids}
+    
+    # Gasto já gravado na execução mensal dos filhos (uma consulta)
+    gasto_by: Dict[int, Decimal] = defaultdict(Decimal)
+    for rid, gasto in db.query(ExecucaoMensal.rubrica_id, ExecucaoMensal.gasto).filter(
+        ExecucaoMensal.rubrica_id.in_(child_ids - set(ancestor_ids)),
+        ExecucaoMensal.mes == mes,
+        ExecucaoMensal.ano == ano
+    ).all():
+        gasto_by[rid] = gasto or Decimal("0.00")
     
-    # Processar cada ancestral (do mais profundo ao mais superficial)
+    # Despesas confirmadas diretamente em cada ancestral (um único GROUP BY)
+    diretas = dict(db.query(Despesa.rubrica_id, func.sum(Despesa.valor)).filter(
+        Despesa.rubrica_id.in_(ancestor_ids),
+        Despesa.mes == mes,
+        Despesa.exercicio == ano,
+        Despesa.status == StatusDespesa.CONFIRMADA
+    ).group_by(Despesa.rubrica_id).all())
+    
+    # Rollup em memória, dos filhos para os pais
+    rows = []
     for ancestor in ancestors:
-        # Buscar todos os filhos diretos
-        children = get_children(db, ancestor.id)
-        
-        # Calcular gasto total somando gastos dos filhos na execução mensal
-        gasto_total = Decimal("0.00")
-        dotacao_total = Decimal("0.00")
-        
-        for child in children:
-            child_exec = db.query(ExecucaoMensal).filter(
-                and_(
-                    ExecucaoMensal.rubrica_id == child.id,
-                    ExecucaoMensal.mes == mes,
-                    ExecucaoMensal.ano == ano
-                )
-            ).first()
-            
-            if child_exec:
-                gasto_total += child_exec.gasto
-                dotacao_total += child_exec.dotacao
-        
-        # Também somar despesas confirmadas diretamente na rubrica ancestral (se houver)
-        despesas_diretas = db.query(func.sum(Despesa.valor)).filter(
-            and_(
-                Despesa.rubrica_id == ancestor.id,
-                Despesa.mes == mes,
-                Despesa.exercicio == ano,
-                Despesa.status == StatusDespesa.CONFIRMADA
-            )
-        ).scalar() or Decimal("0.00")
-        
-        gasto_total += despesas_diretas
-        
-        # Atualizar execução mensal do ancestral
-        ancestor_exec = db.query(ExecucaoMensal).filter(
-            and_(
-                ExecucaoMensal.rubrica_id == ancestor.id,
-                ExecucaoMensal.mes == mes,
-                ExecucaoMensal.ano == ano
-            )
-        ).first()
+        gasto_total = sum(
+            (gasto_by[c] for c in children_of[ancestor.id]), Decimal("0.00")
+        ) + (diretas.get(ancestor.id) or Decimal("0.00"))
+        gasto_by[ancestor.id] = gasto_total
         
         # Rubricas não têm dotação própria - usar dotacao_calculada
         ancestor_dotacao = ancestor.dotacao_calculada or Decimal("0.00")
-        
-        if not ancestor_exec:
-            ancestor_exec = ExecucaoMensal(
-                rubrica_id=ancestor.id,
-                mes=mes,
-                ano=ano,
-                dotacao=ancestor_dotacao,
-                gasto=gasto_total,
-                saldo=ancestor_dotacao - gasto_total
-            )
-            db.add(ancestor_exec)
+        rows.append({
+            "rubrica_id": ancestor.id,
+            "mes": mes,
+            "ano": ano,
+            "dotacao": ancestor_dotacao,
+            "gasto": gasto_total,
+            "saldo": ancestor_dotacao - gasto_total
+        })
+    
+    # Gravar todos os ancestrais numa única instrução
+    upsert_execucao_mensal_rows(db, rows)
+
+
+def upsert_execucao_mensal_rows(db: Session, rows: List[dict]) -> None:
+    """
+    Insere ou atualiza várias linhas de execução mensal numa única instrução.
+    
+    Em conflito (rubrica_id, mes, ano) atualiza gasto e saldo (saldo = dotação
+    existente - gasto). Dialetos sem upsert nativo usam o ORM.
+    """
+    if not rows:
+        return
+    
+    db.flush()
+    dialect = db.get_bind().dialect.name
+    
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
         else:
-            ancestor_exec.gasto = gasto_total
-            ancestor_exec.saldo = ancestor_exec.dotacao - gasto_total
-        
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(ExecucaoMensal).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["rubrica_id", "mes", "ano"],
+            set_={
+                "gasto": stmt.excluded.gasto,
+                "saldo": ExecucaoMensal.dotacao - stmt.excluded.gasto,
+                "actualizado_em": func.now()
+            }
+        )
+        db.execute(stmt)
+    elif dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(ExecucaoMensal).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            gasto=stmt.inserted.gasto,
+            saldo=ExecucaoMensal.dotacao - stmt.inserted.gasto
+        )
+        db.execute(stmt)
+    else:
+        for row in rows:
+            execucao = db.query(ExecucaoMensal).filter(
+                and_(
+                    ExecucaoMensal.rubrica_id == row["rubrica_id"],
+                    ExecucaoMensal.mes == row["mes"],
+                    ExecucaoMensal.ano == row["ano"]
+                )
+            ).first()
+            if not execucao:
+                db.add(ExecucaoMensal(**row))
+            else:
+                execucao.gasto = row["gasto"]
+                execucao.saldo = execucao.dotacao - row["gasto"]
         db.flush()
+    
+    # Objetos de execução mensal já carregados na sessão ficaram desatualizados
+    for obj in list(db.identity_map.values()):
+        if isinstance(obj, ExecucaoMensal):
+            db.expire(obj)
 
 
 def confirm_despesa_with_execucao(
@@ -184,8 +278,130 @@ def confirm_despesa_with_execucao(
         db, despesa.rubrica_id, despesa.mes, despesa.exercicio
     )
     
+    # Um único flush para o que ficou pendente, antes do commit
+    db.flush()
     db.commit()
     db.refresh(despesa)
     
     return despesa
 
+
+
+def confirm_despesas_bulk(
+    db: Session,
+    despesa_ids: List[int],
+    commit: bool = True
+) -> List[Despesa]:
+    """
+    Confirma várias despesas e atualiza a execução mensal de uma só vez.
+    
+    Em vez de percorrer a árvore por despesa, usa um número fixo de consultas:
+    1. Carrega as despesas (IN)
+    2. Carrega o mapa id -> parent_id das rubricas dos exercícios envolvidos
+    3. Soma despesas confirmadas por (rubrica, mês, exercício) num único GROUP BY
+    4. Carrega as execuções mensais existentes (IN) e grava tudo num único flush
+    
+    Com commit=False só faz flush: o chamador (ex: /confirm-batch) confirma tudo
+    na sua própria transação.
+    """
+    despesas = db.query(Despesa).filter(Despesa.id.in_(despesa_ids)).all()
+    
+    encontrados = {d.id for d in despesas}
+    nao_encontrados = [d_id for d_id in despesa_ids if d_id not in encontrados]
+    if nao_encontrados:
+        raise ValueError(f"Despesas {nao_encontrados} não encontradas")
+    
+    sem_rubrica = [d.id for d in despesas if not d.rubrica_id]
+    if sem_rubrica:
+        raise ValueError(
+            f"Despesas {sem_rubrica} devem ter rubrica associada para serem confirmadas"
+        )
+    
+    pendentes = [d for d in despesas if d.status != StatusDespesa.CONFIRMADA]
+    if not pendentes:
+        return despesas  # Todas já confirmadas
+    
+    for despesa in pendentes:
+        despesa.status = StatusDespesa.CONFIRMADA
+    db.flush()
+    
+    exercicios = {d.exercicio for d in pendentes}
+    meses = {(d.mes, d.exercicio) for d in pendentes}
+    
+    # Mapa de hierarquia (uma consulta)
+    rubricas = db.query(
+        Rubrica.id, Rubrica.parent_id, Rubrica.dotacao_calculada
+    ).filter(Rubrica.exercicio.in_(exercicios)).all()
+    parent_of = {r.id: r.parent_id for r in rubricas}
+    dotacao_of = {r.id: r.dotacao_calculada or Decimal("0.00") for r in rubricas}
+    
+    # Rubricas afetadas: as das despesas e todos os seus ancestrais
+    afetadas = set()
+    for despesa in pendentes:
+        node = despesa.rubrica_id
+        while node and node not in afetadas:
+            afetadas.add(node)
+            node = parent_of.get(node)
+    
+    # Gasto direto por (rubrica, mês, exercício) - um único GROUP BY
+    somas = db.query(
+        Despesa.rubrica_id, Despesa.mes, Despesa.exercicio, func.sum(Despesa.valor)
+    ).filter(
+        Despesa.status == StatusDespesa.CONFIRMADA,
+        Despesa.exercicio.in_(exercicios),
+        Despesa.mes.in_({mes for mes, _ in meses}),
+        Despesa.rubrica_id.isnot(None)
+    ).group_by(
+        Despesa.rubrica_id, Despesa.mes, Despesa.exercicio
+    ).all()
+    
+    # Propagar somas para cima pela hierarquia (gasto da subárvore)
+    gasto_por_chave: Dict[Tuple[int, int, int], Decimal] = defaultdict(Decimal)
+    for rubrica_id, mes, exercicio, soma in somas:
+        if (mes, exercicio) not in meses:
+            continue
+        node = rubrica_id
+        while node:
+            if node in afetadas:
+                gasto_por_chave[(node, mes, exercicio)] += soma or Decimal("0.00")
+            node = parent_of.get(node)
+    
+    # Execuções mensais existentes (uma consulta)
+    existentes = {
+        (e.rubrica_id, e.mes, e.ano): e
+        for e in db.query(ExecucaoMensal).filter(
+            ExecucaoMensal.rubrica_id.in_(afetadas),
+            ExecucaoMensal.ano.in_(exercicios),
+            ExecucaoMensal.mes.in_({mes for mes, _ in meses})
+        ).all()
+    }
+    
+    novas = []
+    for rubrica_id in afetadas:
+        for mes, ano in meses:
+            chave = (rubrica_id, mes, ano)
+            gasto = gasto_por_chave.get(chave, Decimal("0.00"))
+            execucao = existentes.get(chave)
+            if execucao:
+                execucao.gasto = gasto
+                execucao.saldo = execucao.dotacao - gasto
+            elif gasto:
+                dotacao = dotacao_of.get(rubrica_id, Decimal("0.00"))
+                novas.append(ExecucaoMensal(
+                    rubrica_id=rubrica_id,
+                    mes=mes,
+                    ano=ano,
+                    dotacao=dotacao,
+                    gasto=gasto,
+                    saldo=dotacao - gasto
+                ))
+    
+    if novas:
+        db.bulk_save_objects(novas)
+    
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+    
+    return despesas
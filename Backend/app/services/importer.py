@@ -1,9 +1,12 @@
 """
 Serviço de importação de CSV/XLSX com normalização e matching.
 """
+import numpy as np
 import pandas as pd
 import json
 import re
+import unicodedata
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple, Any
 from decimal import Decimal, InvalidOperation
 from datetime import datetime
@@ -15,31 +18,56 @@ from app.models import (
     TipoRubrica, StatusRubrica
 )
 from app.crud import (
-    get_rubrica_by_codigo_exercicio, create_rubrica, get_fornecedor,
-    create_despesa, create_import_batch, update_import_batch
+    create_rubrica, get_fornecedor,
+    validate_despesa, create_import_batch, update_import_batch
 )
 from app.schemas import ColumnMapping
 
+# Número de despesas por INSERT em lote
+BULK_INSERT_CHUNK_SIZE = 1000
 
+_WS_RE = re.compile(r'\s+')
+
+# Acentos comuns em português -> ASCII (str.translate é um único loop em C)
+_ACCENT_TBL = str.maketrans(
+    'ÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇáàâãäéèêëíìîïóòôõöúùûüç',
+    'AAAAAEEEEIIIIOOOOOUUUUCaaaaaeeeeiiiiooooouuuuc'
+)
+
+# Valor monetário: símbolo de moeda opcional (€, $, MT, MZN) antes/depois, sinal "-"
+# só logo no início ou após o símbolo, e corpo numérico com separadores (., , e
+# espaços). Qualquer outro texto (ex: "REQ001", "Ref 2024") não é um valor.
+_MOEDA = r'(?:[€$]|MZN|MT)'
+_CURRENCY_RE = re.compile(
+    rf'^{_MOEDA}?\s*(-)?\s*{_MOEDA}?\s*(\d(?:[\d.,\s]*\d)?)\s*{_MOEDA}?$',
+    re.IGNORECASE
+)
+_SEP_RE = re.compile(r'[.,\s]')
+
+
+@lru_cache(maxsize=100_000)
 def normalize_name(name: str) -> str:
     """
     Normaliza nome: uppercase, remove acentos, trim, compacta espaços.
+    Memoizada: nomes repetem-se muito num mesmo ficheiro de importação.
     """
     if not name or not isinstance(name, str):
         return ""
     
-    # Remove acentos (simplificado)
-    import unicodedata
-    name = unicodedata.normalize('NFD', name)
-    name = ''.join(c for c in name if unicodedata.category(c) != 'Mn')
+    # Remove acentos: tabela para os casos comuns, NFD só se restar algo não-ASCII
+    name = name.translate(_ACCENT_TBL)
+    if not name.isascii():
+        name = unicodedata.normalize('NFD', name)
+        name = ''.join(c for c in name if unicodedata.category(c) != 'Mn')
     
     # Uppercase, trim, compacta espaços
     name = name.upper().strip()
-    name = re.sub(r'\s+', ' ', name)
+    name = _WS_RE.sub(' ', name)
     
     return name
 
 
+@lru_cache(maxsize=100_000)
 def normalize_code(codigo: str) -> str:
     """
     Normaliza código: trim + uppercase.
@@ -56,35 +84,43 @@ def parse_currency(valor_str: str) -> Optional[Decimal]:
     - "1,234,567.89" (formato EN)
     - "1234567.89"
     - "1234567,89"
+    
+    O último separador (. ou ,) é o decimal; os anteriores são de milhares
+    ("1.234.567" -> 1234567). Valores entre parênteses são negativos
+    ("(1.234,56)" -> -1234.56, notação contabilística).
     """
     if not valor_str or not isinstance(valor_str, str):
         return None
     
-    # Remove espaços e símbolos de moeda
-    valor_str = valor_str.strip().replace("€", "").replace("$", "").replace(" ", "")
+    texto = valor_str.strip()
+    entre_parenteses = texto.startswith("(") and texto.endswith(")")
+    if entre_parenteses:
+        texto = texto[1:-1].strip()
     
-    if not valor_str:
+    m = _CURRENCY_RE.match(texto)
+    if not m:
         return None
     
-    # Detecta formato: se tem ponto e vírgula, verifica qual é separador decimal
-    if "." in valor_str and "," in valor_str:
-        # Verifica qual vem por último (geralmente é o separador decimal)
-        last_dot = valor_str.rfind(".")
-        last_comma = valor_str.rfind(",")
-        
-        if last_dot > last_comma:
-            # Formato EN: 1,234,567.89
-            valor_str = valor_str.replace(",", "")
-        else:
-            # Formato PT: 1.234.567,89
-            valor_str = valor_str.replace(".", "").replace(",", ".")
-    elif "," in valor_str:
-        # Apenas vírgula, assume separador decimal
-        valor_str = valor_str.replace(".", "").replace(",", ".")
-    # Se só tem ponto ou nenhum, assume formato padrão
+    sinal, corpo = m.groups()
+    if entre_parenteses:
+        if sinal:
+            # "(-50)": sinal duplo ambíguo
+            return None
+        sinal = "-"
+    ultimo_sep = max(corpo.rfind("."), corpo.rfind(","))
+    
+    if ultimo_sep == -1 or (
+        corpo.count(corpo[ultimo_sep]) > 1 and ("." in corpo) != ("," in corpo)
+    ):
+        # Sem separador, ou apenas separadores de milhares (ex: "1.234.567")
+        numero = _SEP_RE.sub("", corpo)
+    else:
+        inteiro = _SEP_RE.sub("", corpo[:ultimo_sep])
+        decimal = _WS_RE.sub("", corpo[ultimo_sep + 1:])
+        numero = f"{inteiro}.{decimal}"
     
     try:
-        return Decimal(valor_str)
+        return Decimal(f"{sinal or ''}{numero}")
     except (InvalidOperation, ValueError):
         return None
 
@@ -97,6 +133,8 @@ def parse_date(date_str: str) -> Optional[datetime]:
         return None
     
     date_str = date_str.strip()
+    if not date_str:
+        return None
     
     # Formatos comuns
     formats = [
@@ -123,12 +161,34 @@ def parse_date(date_str: str) -> Optional[datetime]:
     return None
 
 
+def _detect_encoding(file_path: str) -> str:
+    """
+    Detecta o encoding de um CSV: UTF-8 (com ou sem BOM) ou latin-1.
+    latin-1 aceita qualquer sequência de bytes, pelo que serve de fallback.
+    """
+    try:
+        Path(file_path).read_bytes().decode("utf-8")
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
 class FornecedorMatcher:
     """Classe para matching de fornecedores."""
     
     def __init__(self, db: Session):
         self.db = db
         self._cache = None
+        # Índices para lookups exatos O(1) (primeira ocorrência prevalece)
+        self._by_nuit: Dict[str, Dict[str, Any]] = {}
+        self._by_codigo: Dict[str, Dict[str, Any]] = {}
+        self._by_nome: Dict[str, Dict[str, Any]] = {}
+        # Arrays paralelos para fuzzy matching (apenas nomes não vazios)
+        self._names: List[str] = []
+        self._ids: List[int] = []
+        self._nomes_originais: List[str] = []
+        # Melhor candidato fuzzy pré-calculado por nome normalizado: (índice, score) ou None
+        self._fuzzy_hits: Dict[str, Optional[Tuple[int, int]]] = {}
     
     def _load_fornecedores(self):
         """Carrega todos os fornecedores ativos em cache."""
@@ -147,6 +207,51 @@ class FornecedorMatcher:
                     "nome_normalizado": normalize_name(usuario.nome) if usuario.nome else "",
                     "nome_original": usuario.nome
                 })
+            
+            for f in self._cache:
+                if f["nuit"]:
+                    self._by_nuit.setdefault(f["nuit"], f)
+                if f["codigo_interno"]:
+                    self._by_codigo.setdefault(f["codigo_interno"], f)
+                self._by_nome.setdefault(f["nome_normalizado"], f)
+                if f["nome_normalizado"]:
+                    self._names.append(f["nome_normalizado"])
+                    self._ids.append(f["id"])
+                    self._nomes_originais.append(f["nome_original"])
+    
+    def prefetch_fuzzy(self, nomes: List[str], score_cutoff: int = 90) -> None:
+        """
+        Calcula de uma vez os melhores candidatos fuzzy para vários nomes.
+        
+        Usa uma matriz process.cdist (multi-thread, uint8) em vez de um
+        extractOne por linha; match() passa a consultar o resultado.
+        """
+        self._load_fornecedores()
+        
+        queries = []
+        for nome in nomes:
+            nome_norm = normalize_name(nome) if nome else ""
+            if (nome_norm and nome_norm not in self._by_nome
+                    and nome_norm not in self._fuzzy_hits):
+                queries.append(nome_norm)
+        queries = list(dict.fromkeys(queries))
+        
+        if not queries or not self._names:
+            return
+        
+        mat = process.cdist(
+            queries,
+            self._names,
+            scorer=fuzz.ratio,
+            score_cutoff=score_cutoff,
+            dtype=np.uint8,
+            workers=-1
+        )
+        best = mat.argmax(axis=1)
+        scores = mat.max(axis=1)
+        
+        for nome_norm, idx, score in zip(queries, best.tolist(), scores.tolist()):
+            self._fuzzy_hits[nome_norm] = (idx, score) if score >= score_cutoff else None
     
     def match(self, nome: str, nuit: Optional[str] = None, codigo: Optional[str] = None) -> Tuple[Optional[int], Dict[str, Any]]:
         """
@@ -172,54 +277,56 @@ class FornecedorMatcher:
         
         # 1. Match por NUIT
         if nuit_norm:
-            for f in self._cache:
-                if f["nuit"] and f["nuit"] == nuit_norm:
-                    return f["id"], sugestoes
+            f = self._by_nuit.get(nuit_norm)
+            if f:
+                return f["id"], sugestoes
         
         # 2. Match por código interno
         if codigo_norm:
-            for f in self._cache:
-                if f["codigo_interno"] and f["codigo_interno"] == codigo_norm:
-                    sugestoes["exact_matches"].append({
-                        "id": f["id"],
-                        "nome": f["nome_original"],
-                        "tipo": "codigo_interno"
-                    })
-                    return f["id"], sugestoes
-        
-        # 3. Match exato por nome normalizado
-        for f in self._cache:
-            if f["nome_normalizado"] == nome_norm:
+            f = self._by_codigo.get(codigo_norm)
+            if f:
                 sugestoes["exact_matches"].append({
                     "id": f["id"],
                     "nome": f["nome_original"],
-                    "tipo": "nome_exato"
+                    "tipo": "codigo_interno"
                 })
                 return f["id"], sugestoes
         
-        # 4. Fuzzy match
-        if nome_norm:
-            matches = process.extract(
-                nome_norm,
-                [f["nome_normalizado"] for f in self._cache if f["nome_normalizado"]],
-                limit=5,
-                scorer=fuzz.ratio
-            )
+        # 3. Match exato por nome normalizado
+        f = self._by_nome.get(nome_norm)
+        if f:
+            sugestoes["exact_matches"].append({
+                "id": f["id"],
+                "nome": f["nome_original"],
+                "tipo": "nome_exato"
+            })
+            return f["id"], sugestoes
+        
+        # 4. Fuzzy match (pré-calculado em prefetch_fuzzy ou extractOne,
+        #    que devolve o índice em self._names)
+        if nome_norm and self._names:
+            if nome_norm in self._fuzzy_hits:
+                hit = self._fuzzy_hits[nome_norm]
+            else:
+                hit = process.extractOne(
+                    nome_norm,
+                    self._names,
+                    scorer=fuzz.ratio,
+                    score_cutoff=90
+                )
+                hit = (hit[2], hit[1]) if hit else None
+                # Nomes repetidos no mesmo arquivo não voltam a ser pontuados
+                self._fuzzy_hits[nome_norm] = hit
             
-            for match_name, score, _ in matches:
-                if score >= 90:
-                    # Encontra o fornecedor correspondente
-                    for f in self._cache:
-                        if f["nome_normalizado"] == match_name:
-                            sugestoes["fuzzy_matches"].append({
-                                "id": f["id"],
-                                "nome": f["nome_original"],
-                                "score": score,
-                                "tipo": "fuzzy"
-                            })
-                            if score >= 90:
-                                return f["id"], sugestoes
-                            break
+            if hit:
+                idx, score = hit
+                sugestoes["fuzzy_matches"].append({
+                    "id": self._ids[idx],
+                    "nome": self._nomes_originais[idx],
+                    "score": score,
+                    "tipo": "fuzzy"
+                })
+                return self._ids[idx], sugestoes
         
         return None, sugestoes
 
@@ -230,6 +337,17 @@ class RubricaMatcher:
     def __init__(self, db: Session, exercicio: int):
         self.db = db
         self.exercicio = exercicio
+        # {codigo: id} do exercício, carregado na primeira chamada a match
+        self._rubrica_index: Optional[Dict[str, int]] = None
+    
+    def _load_index(self) -> Dict[str, int]:
+        """Carrega código -> id de todas as rubricas do exercício numa só query."""
+        if self._rubrica_index is None:
+            rows = self.db.query(Rubrica.codigo, Rubrica.id).filter(
+                Rubrica.exercicio == self.exercicio
+            ).all()
+            self._rubrica_index = {codigo: rid for codigo, rid in rows}
+        return self._rubrica_index
     
     def match(self, codigo: str) -> Tuple[Optional[int], bool]:
         """
@@ -240,10 +358,9 @@ class RubricaMatcher:
         """
         codigo_norm = normalize_code(codigo)
         
-        rubrica = get_rubrica_by_codigo_exercicio(self.db, codigo_norm, self.exercicio)
-        
-        if rubrica:
-            return rubrica.id, False
+        rubrica_id = self._load_index().get(codigo_norm)
+        if rubrica_id:
+            return rubrica_id, False
         
         # Cria rubrica provisória
         from app.schemas import RubricaCreate
@@ -258,6 +375,8 @@ class RubricaMatcher:
         )
         
         nova_rubrica = create_rubrica(self.db, rubrica_create)
+        # Atualiza a entrada do índice para as próximas linhas com o mesmo código
+        self._rubrica_index[codigo_norm] = nova_rubrica.id
         return nova_rubrica.id, True
 
 
@@ -281,25 +400,30 @@ class ImportProcessor:
             sheet_name: Nome da folha do Excel (None = primeira folha)
         """
         if file_type == "csv":
-            # Tenta detectar encoding e separador
+            # Detecta encoding uma vez (sem reler o arquivo a cada tentativa)
+            encoding = _detect_encoding(file_path)
+            # dtype=str: colunas estáveis como texto (códigos como "1.10" não viram 1.1);
+            # o parse de valores/datas é feito depois, coluna a coluna
             try:
-                df = pd.read_csv(file_path, encoding="utf-8")
-            except:
-                try:
-                    df = pd.read_csv(file_path, encoding="latin-1")
-                except:
-                    df = pd.read_csv(file_path, encoding="iso-8859-1")
+                # Parser multi-thread do Arrow, quando pyarrow está instalado
+                df = pd.read_csv(file_path, encoding=encoding, dtype=str, engine="pyarrow")
+            except ImportError:
+                df = pd.read_csv(file_path, encoding=encoding, dtype=str)
         elif file_type == "xlsx":
             # Se sheet_name não especificado, lê a primeira folha
             try:
-                df = pd.read_excel(
-                    file_path, 
-                    engine="openpyxl", 
+                excel_kwargs = dict(
                     sheet_name=sheet_name,
                     header=0,  # Primeira linha como cabeçalho
                     na_values=['', ' ', 'NaN', 'N/A'],  # Valores a considerar como NaN
                     keep_default_na=True
                 )
+                try:
+                    # calamine (Rust) é bem mais rápido; openpyxl só se python-calamine
+                    # não estiver instalado (um ficheiro inválido não é relido)
+                    df = pd.read_excel(file_path, engine="calamine", **excel_kwargs)
+                except ImportError:
+                    df = pd.read_excel(file_path, engine="openpyxl", **excel_kwargs)
                 # Se retornar dict (múltiplas folhas), pega a primeira
                 if isinstance(df, dict):
                     df = list(df.values())[0] if df else pd.DataFrame()
@@ -328,7 +452,10 @@ class ImportProcessor:
             if not os.path.exists(file_path):
                 raise ValueError(f"Arquivo não encontrado: {file_path}")
             
-            excel_file = pd.ExcelFile(file_path, engine="openpyxl")
+            try:
+                excel_file = pd.ExcelFile(file_path, engine="calamine")
+            except ImportError:
+                excel_file = pd.ExcelFile(file_path, engine="openpyxl")
             sheet_names = excel_file.sheet_names
             
             return sheet_names if sheet_names else []
@@ -342,14 +469,10 @@ class ImportProcessor:
                 except:
                     pass
     
-    def process_row(
-        self, row: Dict[str, Any], mapping: ColumnMapping, linha_numero: int
-    ) -> Dict[str, Any]:
-        """
-        Processa uma linha do arquivo.
-        Retorna dict com dados processados e erros.
-        """
-        resultado = {
+    @staticmethod
+    def _novo_resultado(linha_numero: int) -> Dict[str, Any]:
+        """Resultado vazio do processamento de uma linha."""
+        return {
             "linha_numero": linha_numero,
             "erros": [],
             "warnings": [],
@@ -359,6 +482,15 @@ class ImportProcessor:
             "fornecedor_criado": False,
             "rubrica_criada": False
         }
+    
+    def process_row(
+        self, row: Dict[str, Any], mapping: ColumnMapping, linha_numero: int
+    ) -> Dict[str, Any]:
+        """
+        Processa uma linha do arquivo.
+        Retorna dict com dados processados e erros.
+        """
+        resultado = self._novo_resultado(linha_numero)
         
         # Extrai valores das colunas
         try:
@@ -375,6 +507,76 @@ class ImportProcessor:
             resultado["erros"].append(f"Erro ao extrair colunas: {str(e)}")
             return resultado
         
+        return self._process_values(
+            resultado,
+            codigo_rubrica=codigo_rubrica,
+            fornecedor_nome=fornecedor_nome,
+            valor_str=valor_str,
+            valor=parse_currency(valor_str),
+            data_str=data_str,
+            data_emissao=parse_date(data_str) if data_str else None,
+            ordem_pagamento=ordem_pagamento,
+            justificativo=justificativo,
+            requisicao=requisicao
+        )
+    
+    def _normalize_columns(self, df: pd.DataFrame, mapping: ColumnMapping) -> pd.DataFrame:
+        """
+        Extrai e normaliza as colunas mapeadas de uma vez (operações vetorizadas).
+        Mantém o índice original do DataFrame para o número da linha.
+        """
+        def coluna(nome: Optional[str]) -> pd.Series:
+            if nome and nome in df.columns:
+                return df[nome].fillna("").astype(str).str.strip()
+            return pd.Series("", index=df.index, dtype=object)
+        
+        def opcional(nome: Optional[str]) -> pd.Series:
+            if not nome:
+                return pd.Series([None] * len(df), index=df.index, dtype=object)
+            return coluna(nome)
+        
+        df_norm = pd.DataFrame({
+            "codigo_rubrica": coluna(mapping.codigo_rubrica),
+            "fornecedor_nome": coluna(mapping.fornecedor),
+            "valor_str": coluna(mapping.valor),
+            "data_str": opcional(mapping.data),
+            "ordem_pagamento": opcional(mapping.ordem_pagamento),
+            "justificativo": opcional(mapping.justificativo),
+            "requisicao": opcional(mapping.requisicao),
+        }, index=df.index)
+        
+        df_norm["valor"] = df_norm["valor_str"].map(parse_currency)
+        # Datas: um único pd.to_datetime para a coluna inteira (parse_date fica
+        # para chamadas avulsas). dtype=object mantém datetime/None em vez de Timestamp/NaT
+        if mapping.data and mapping.data in df.columns:
+            datas = pd.to_datetime(
+                df_norm["data_str"], errors="coerce", dayfirst=True, format="mixed"
+            )
+            df_norm["data_emissao"] = pd.Series(
+                [None if pd.isna(d) else d.to_pydatetime() for d in datas],
+                index=df.index, dtype=object
+            )
+        else:
+            df_norm["data_emissao"] = pd.Series([None] * len(df), index=df.index, dtype=object)
+        
+        return df_norm
+    
+    def _process_values(
+        self,
+        resultado: Dict[str, Any],
+        codigo_rubrica: str,
+        fornecedor_nome: str,
+        valor_str: str,
+        valor: Optional[Decimal],
+        data_str: Optional[str],
+        data_emissao: Optional[datetime],
+        ordem_pagamento: Optional[str],
+        justificativo: Optional[str],
+        requisicao: Optional[str]
+    ) -> Dict[str, Any]:
+        """
+        Valida e faz matching de uma linha com valores já extraídos e parseados.
+        """
         # Validações básicas
         if not codigo_rubrica:
             resultado["erros"].append("Código de rubrica vazio")
@@ -382,19 +584,15 @@ class ImportProcessor:
         if not fornecedor_nome:
             resultado["erros"].append("Nome de fornecedor vazio")
         
-        # Parse valor
-        valor = parse_currency(valor_str)
+        # Valor (já parseado)
         if valor is None:
             resultado["erros"].append(f"Valor inválido: {valor_str}")
         elif valor <= 0:
             resultado["erros"].append(f"Valor deve ser positivo: {valor}")
         
-        # Parse data
-        data_emissao = None
-        if data_str:
-            data_emissao = parse_date(data_str)
-            if data_emissao is None:
-                resultado["warnings"].append(f"Data não reconhecida: {data_str}")
+        # Data (já parseada)
+        if data_str and data_emissao is None:
+            resultado["warnings"].append(f"Data não reconhecida: {data_str}")
         
         # Se há erros críticos, para aqui
         if resultado["erros"]:
@@ -461,17 +659,45 @@ class ImportProcessor:
                 "error": f"Erro ao ler arquivo: {str(e)}"
             }
         
-        total_rows = len(df)
         criadas = 0
         atualizadas = 0
         erros = 0
         detalhes_erros = []
+        # Despesas validadas, inseridas em lote no fim: (linha_numero, dados)
+        despesas_validas = []
+        
+        # Normalização/parse coluna a coluna; a iteração fica só para validação e matching
+        df_norm = self._normalize_columns(df, mapping)
+        
+        # Descarta linhas em branco (rubrica, fornecedor e valor vazios ou só espaços);
+        # o índice original é mantido para numerar as linhas nos erros
+        preenchida = (
+            df_norm["codigo_rubrica"].ne("")
+            | df_norm["fornecedor_nome"].ne("")
+            | df_norm["valor_str"].ne("")
+        )
+        df_norm = df_norm[preenchida]
+        total_rows = len(df_norm)
+        
+        # Fuzzy matching de fornecedores calculado numa só matriz para o arquivo todo
+        self.fornecedor_matcher.prefetch_fuzzy(df_norm["fornecedor_nome"].unique().tolist())
         
         # Processa cada linha
-        for idx, row in df.iterrows():
-            linha_numero = idx + 2  # +2 porque começa em 0 e há header
+        for row in df_norm.itertuples():
+            linha_numero = row.Index + 2  # +2 porque começa em 0 e há header
             
-            resultado = self.process_row(row.to_dict(), mapping, linha_numero)
+            resultado = self._process_values(
+                self._novo_resultado(linha_numero),
+                codigo_rubrica=row.codigo_rubrica,
+                fornecedor_nome=row.fornecedor_nome,
+                valor_str=row.valor_str,
+                valor=row.valor,
+                data_str=row.data_str,
+                data_emissao=row.data_emissao,
+                ordem_pagamento=row.ordem_pagamento,
+                justificativo=row.justificativo,
+                requisicao=row.requisicao
+            )
             
             if resultado["erros"]:
                 erros += 1
@@ -482,16 +708,17 @@ class ImportProcessor:
                 })
                 continue
             
-            # Cria despesa se não for dry_run
+            # Valida despesa se não for dry_run (inserção em lote abaixo)
             if not dry_run and resultado["despesa_data"]:
                 try:
                     from app.schemas import DespesaCreate
-                    despesa_create = DespesaCreate(
-                        **resultado["despesa_data"],
-                        batch_id=batch_id
+                    despesa_create = validate_despesa(
+                        self.db, DespesaCreate(**resultado["despesa_data"])
                     )
-                    create_despesa(self.db, despesa_create)
-                    criadas += 1
+                    despesa_dict = despesa_create.model_dump()
+                    despesa_dict["status"] = StatusDespesa.PENDENTE
+                    despesa_dict["batch_id"] = batch_id
+                    despesas_validas.append((linha_numero, despesa_dict))
                 except Exception as e:
                     erros += 1
                     detalhes_erros.append({
@@ -499,6 +726,29 @@ class ImportProcessor:
                         "erros": [f"Erro ao criar despesa: {str(e)}"]
                     })
         
+        # Insere despesas em lotes (sem INSERT/commit por linha)
+        if despesas_validas:
+            try:
+                for i in range(0, len(despesas_validas), BULK_INSERT_CHUNK_SIZE):
+                    chunk = despesas_validas[i:i + BULK_INSERT_CHUNK_SIZE]
+                    self.db.bulk_insert_mappings(Despesa, [dados for _, dados in chunk])
+                self.db.commit()
+                criadas += len(despesas_validas)
+            except Exception as e:
+                self.db.rollback()
+                erros += len(despesas_validas)
+                detalhes_erros.extend(
+                    {
+                        "linha": linha_numero,
+                        "erros": [f"Erro ao criar despesa: {str(e)}"]
+                    }
+                    for linha_numero, _ in despesas_validas
+                )
+        
+        # Libera memória dos caches de normalização deste ficheiro
+        normalize_name.cache_clear()
+        normalize_code.cache_clear()
+        
         # Atualiza batch
         if not dry_run:
             update_import_batch(
@@ -2,10 +2,29 @@
 Serviço para gerenciar dotação agregada de rubricas por hierarquia.
 """
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy import select, text
 from typing import List, Optional
 from decimal import Decimal
-from app.models import Rubrica
+from collections import defaultdict
+from app.models import Rubrica, StatusRubrica, traversal_contains
+
+# Chave em session.info do cache rubrica_id -> é folha (ver is_leaf_rubrica)
+_LEAF_CACHE_KEY = "_rubrica_leaf_cache"
+# Chaves em session.info dos caches rubrica_id -> ancestrais / descendentes
+_ANCESTORS_CACHE_KEY = "_rubrica_anc_cache"
+_DESCENDANTS_CACHE_KEY = "_rubrica_desc_cache"
+_TREE_CACHE_KEYS = (_LEAF_CACHE_KEY, _ANCESTORS_CACHE_KEY, _DESCENDANTS_CACHE_KEY)
+
+# Dialetos em que o rollup de dotacao_calculada é feito em SQL (SUM na base de dados)
+_SQL_ROLLUP_DIALECTS = ("mysql", "postgresql")
+
+
+def clear_rubrica_tree_cache(session: Session) -> None:
+    """Descarta os caches da hierarquia guardados na sessão (após mudar a árvore)."""
+    for key in _TREE_CACHE_KEYS:
+        session.info.pop(key, None)
 
 
 def get_children(session: Session, rubrica_id: int) -> List[Rubrica]:
@@ -16,78 +35,159 @@ def get_children(session: Session, rubrica_id: int) -> List[Rubrica]:
 
 
 def get_all_descendants(session: Session, rubrica_id: int) -> List[Rubrica]:
-    """Retorna todas as rubricas descendentes (filhas, netas, etc.) usando CTE recursivo."""
-    try:
-        query = text("""
-            WITH RECURSIVE descendants AS (
-                -- Anchor: rubrica inicial
-                SELECT id, parent_id, codigo, designacao
+    """
+    Retorna todas as rubricas descendentes (filhas, netas, etc.) via traversal_ids.
+    Resultado memoizado em session.info, invalidado por recalculate_dotacao_chain.
+    """
+    cache = session.info.setdefault(_DESCENDANTS_CACHE_KEY, {})
+    if rubrica_id not in cache:
+        cache[rubrica_id] = session.query(Rubrica).filter(
+            traversal_contains(session.get_bind(), rubrica_id)
+        ).all()
+    return list(cache[rubrica_id])
+
+
+def get_ancestors(session: Session, rubrica_id: int) -> List[Rubrica]:
+    """
+    Retorna todos os ancestrais de uma rubrica (pai, avô, etc.) incluindo a própria rubrica.
+    Usa o caminho materializado traversal_ids (uma consulta por IN).
+    Resultado memoizado em session.info, invalidado por recalculate_dotacao_chain.
+    """
+    cache = session.info.setdefault(_ANCESTORS_CACHE_KEY, {})
+    if rubrica_id not in cache:
+        cache[rubrica_id] = _load_ancestors(session, rubrica_id)
+    return list(cache[rubrica_id])
+
+
+def _load_ancestors(session: Session, rubrica_id: int) -> List[Rubrica]:
+    """Carrega da base de dados os ancestrais (incluindo a própria rubrica)."""
+    rubrica = session.get(Rubrica, rubrica_id)
+    if not rubrica:
+        return []
+    
+    if rubrica.parent_id and not rubrica.traversal_ids:
+        # Caminho ainda não preenchido (ex: linha anterior à migração): percorrer
+        # o mapa id -> parent_id do exercício em memória, carregado numa consulta
+        parent_map = dict(session.execute(
+            text("SELECT id, parent_id FROM rubrica WHERE exercicio = :exercicio"),
+            {"exercicio": rubrica.exercicio}
+        ).all())
+        ids = []
+        current_id = rubrica.id
+        while current_id and current_id not in ids:
+            ids.append(current_id)
+            current_id = parent_map.get(current_id)
+    else:
+        ids = list(rubrica.traversal_ids or []) + [rubrica.id]
+    
+    return session.query(Rubrica).filter(Rubrica.id.in_(ids)).all()
+
+
+def recalculate_dotacao_exercicio_sql(session: Session, exercicio: int) -> None:
+    """
+    Recalcula dotacao_calculada de todas as rubricas do exercício em SQL, sem hidratar ORM.
+    
+    1. Folhas (sem filhos ativos) → dotacao_inicial (ou 0)
+    2. Pais, profundidade a profundidade do mais profundo para o mais alto → soma
+       dos filhos ativos. A profundidade é o tamanho de traversal_ids (não nivel,
+       que é informativo e pode não coincidir com a árvore real).
+    """
+    params = {"exercicio": exercicio, "ativa": StatusRubrica.ATIVA.name}
+    
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "mysql":
+        profundidade = "JSON_LENGTH(traversal_ids)"
+    else:
+        profundidade = "json_array_length(traversal_ids)"
+    
+    if dialect_name == "mysql":
+        # MySQL não permite subconsulta na própria tabela do UPDATE (erro 1093): usar JOIN
+        leaves_query = text("""
+            UPDATE rubrica r
+            LEFT JOIN (
+                SELECT DISTINCT parent_id
+                FROM rubrica
+                WHERE exercicio = :exercicio AND status = :ativa AND parent_id IS NOT NULL
+            ) c ON c.parent_id = r.id
+            SET r.dotacao_calculada = COALESCE(r.dotacao_inicial, 0)
+            WHERE r.exercicio = :exercicio AND c.parent_id IS NULL
+        """)
+        level_query = text("""
+            UPDATE rubrica p
+            INNER JOIN (
+                SELECT parent_id, SUM(COALESCE(dotacao_calculada, 0)) AS total
                 FROM rubrica
-                WHERE parent_id = :rubrica_id
-                
-                UNION ALL
-                
-                -- Recursive: filhos dos filhos
-                SELECT r.id, r.parent_id, r.codigo, r.designacao
-                FROM rubrica r
-                INNER JOIN descendants d ON r.parent_id = d.id
+                WHERE exercicio = :exercicio AND status = :ativa AND parent_id IS NOT NULL
+                GROUP BY parent_id
+            ) c ON c.parent_id = p.id
+            SET p.dotacao_calculada = c.total
+            WHERE p.exercicio = :exercicio AND JSON_LENGTH(p.traversal_ids) = :profundidade
+        """)
+    else:
+        leaves_query = text("""
+            UPDATE rubrica
+            SET dotacao_calculada = COALESCE(dotacao_inicial, 0)
+            WHERE exercicio = :exercicio
+            AND NOT EXISTS (
+                SELECT 1 FROM rubrica c
+                WHERE c.parent_id = rubrica.id AND c.status = :ativa
             )
-            SELECT id FROM descendants
         """)
-        
-        result = session.execute(query, {"rubrica_id": rubrica_id})
-        ids = [row[0] for row in result]
-        
-        if ids:
-            return session.query(Rubrica).filter(Rubrica.id.in_(ids)).all()
-        return []
-    except Exception:
-        # Fallback: busca simples sem CTE (para MySQL < 8 ou erro)
-        return get_children(session, rubrica_id)
+        level_query = text("""
+            UPDATE rubrica
+            SET dotacao_calculada = (
+                SELECT SUM(COALESCE(c.dotacao_calculada, 0)) FROM rubrica c
+                WHERE c.parent_id = rubrica.id AND c.status = :ativa
+            )
+            WHERE exercicio = :exercicio AND json_array_length(traversal_ids) = :profundidade
+            AND EXISTS (
+                SELECT 1 FROM rubrica c
+                WHERE c.parent_id = rubrica.id AND c.status = :ativa
+            )
+        """)
+    
+    session.execute(leaves_query, params)
+    
+    max_profundidade = session.execute(
+        text(f"SELECT MAX({profundidade}) FROM rubrica WHERE exercicio = :exercicio"),
+        {"exercicio": exercicio}
+    ).scalar() or 0
+    for nivel in range(max_profundidade, -1, -1):
+        session.execute(level_query, {**params, "profundidade": nivel})
 
 
-def get_ancestors(session: Session, rubrica_id: int) -> List[Rubrica]:
+def _recalculate_dotacao_chain_sql(session: Session, chain: List[int]) -> None:
     """
-    Retorna todos os ancestrais de uma rubrica (pai, avô, etc.) incluindo a própria rubrica.
-    Usa CTE recursivo do MySQL 8+.
+    Recalcula em SQL apenas a cadeia dada (a rubrica e os seus ancestrais, do mais
+    profundo para a raiz): um UPDATE de uma linha por nó, com o SUM dos filhos ativos
+    (cujos valores já estão corretos) ou dotacao_inicial se for folha.
     """
-    try:
-        query = text("""
-            WITH RECURSIVE ancestors AS (
-                -- Anchor: rubrica inicial
-                SELECT id, parent_id, codigo, designacao
+    if session.get_bind().dialect.name == "mysql":
+        # MySQL não permite subconsulta na própria tabela do UPDATE (erro 1093):
+        # a tabela derivada agregada é materializada antes do UPDATE
+        node_query = text("""
+            UPDATE rubrica r
+            CROSS JOIN (
+                SELECT SUM(COALESCE(dotacao_calculada, 0)) AS total
                 FROM rubrica
-                WHERE id = :rubrica_id
-                
-                UNION ALL
-                
-                -- Recursive: pai do pai
-                SELECT r.id, r.parent_id, r.codigo, r.designacao
-                FROM rubrica r
-                INNER JOIN ancestors a ON r.id = a.parent_id
+                WHERE parent_id = :id AND status = :ativa
+            ) c
+            SET r.dotacao_calculada = COALESCE(c.total, r.dotacao_inicial, 0)
+            WHERE r.id = :id
+        """)
+    else:
+        node_query = text("""
+            UPDATE rubrica
+            SET dotacao_calculada = COALESCE(
+                (SELECT SUM(COALESCE(c.dotacao_calculada, 0)) FROM rubrica c
+                 WHERE c.parent_id = :id AND c.status = :ativa),
+                dotacao_inicial, 0
             )
-            SELECT id FROM ancestors
+            WHERE id = :id
         """)
-        
-        result = session.execute(query, {"rubrica_id": rubrica_id})
-        ids = [row[0] for row in result]
-        
-        if ids:
-            return session.query(Rubrica).filter(Rubrica.id.in_(ids)).all()
-        return []
-    except Exception:
-        # Fallback: busca iterativa sem CTE
-        ancestors = []
-        current_id = rubrica_id
-        
-        while current_id:
-            rubrica = session.query(Rubrica).filter(Rubrica.id == current_id).first()
-            if not rubrica:
-                break
-            ancestors.append(rubrica)
-            current_id = rubrica.parent_id
-        
-        return ancestors
+    ativa = StatusRubrica.ATIVA.name
+    for node_id in chain:
+        session.execute(node_query, {"id": node_id, "ativa": ativa})
 
 
 def recalculate_dotacao_chain(session: Session, rubrica_id: int) -> None:
@@ -100,112 +200,149 @@ def recalculate_dotacao_chain(session: Session, rubrica_id: int) -> None:
     
     Atualiza todos os ancestrais recursivamente.
     Processa do mais profundo para o mais alto (folhas primeiro).
+    No MySQL/PostgreSQL só a cadeia (rubrica + ancestrais, via traversal_ids) é
+    recalculada em SQL, com um SUM dos filhos por nó; o cálculo em Python fica
+    para os restantes dialetos e para linhas sem traversal_ids preenchido.
     """
-    try:
-        # Obter todos os ancestrais (incluindo a própria rubrica)
-        ancestors = get_ancestors(session, rubrica_id)
-        
-        if not ancestors:
-            # Se não há ancestrais, buscar a própria rubrica
-            rubrica = session.query(Rubrica).filter(Rubrica.id == rubrica_id).first()
-            if not rubrica:
-                return
-            ancestors = [rubrica]
-    except Exception as e:
-        import logging
-        logging.warning(f"Erro ao buscar ancestrais para rubrica {rubrica_id}: {e}")
-        # Se houver erro, buscar apenas a própria rubrica
-        try:
-            rubrica = session.query(Rubrica).filter(Rubrica.id == rubrica_id).first()
-            if not rubrica:
-                return
-            ancestors = [rubrica]
-        except:
-            return
-    
-    # Buscar todas as rubricas do mesmo exercício para garantir que temos filhos atualizados
-    from app.models import StatusRubrica
-    if ancestors:
-        exercicio = ancestors[0].exercicio
-        from sqlalchemy.orm import defer
-        # Buscar TODAS as rubricas do exercício (ativas e inativas) para cálculo correto
-        # Mas apenas calcular dotacao_calculada para ativas
-        all_rubricas = session.query(Rubrica).filter(
-            Rubrica.exercicio == exercicio
-        ).all()
-    else:
-        all_rubricas = []
+    # A hierarquia pode ter mudado: descartar os caches da árvore na sessão
+    clear_rubrica_tree_cache(session)
+    
+    # Alterações pendentes (ex: dotacao_inicial) têm de estar visíveis nas consultas abaixo
+    session.flush()
+    row = session.execute(
+        select(Rubrica.exercicio, Rubrica.parent_id, Rubrica.traversal_ids)
+        .where(Rubrica.id == rubrica_id)
+    ).first()
+    if row is None:
+        return
+    exercicio, parent_id, traversal_ids = row
+    
+    if session.get_bind().dialect.name in _SQL_ROLLUP_DIALECTS and (
+        traversal_ids or not parent_id
+    ):
+        # Do mais profundo para a raiz: a própria rubrica e depois os ancestrais
+        chain = [rubrica_id] + list(reversed(traversal_ids or []))
+        _recalculate_dotacao_chain_sql(session, chain)
+        _expire_dotacao_calculada(session, chain)
+        return
+    
+    _recalculate_dotacao_python(session, exercicio, rubrica_id)
+
+
+def recalculate_dotacao_exercicio(session: Session, exercicio: int) -> None:
+    """
+    Recalcula dotacao_calculada de todas as rubricas do exercício numa única passagem.
     
-    # Criar dicionário por ID
-    rubricas_dict = {r.id: r for r in all_rubricas}
+    Substitui chamar recalculate_dotacao_chain rubrica a rubrica (que subiria a mesma
+    cadeia de ancestrais uma vez por rubrica): cada nível é tratado de uma vez.
+    """
+    clear_rubrica_tree_cache(session)
+    session.flush()
     
-    # Processar do mais profundo para o mais alto (folhas primeiro, depois pais)
-    # Ordenar por nível descendente (maior nível primeiro)
-    ancestors_sorted = sorted(ancestors, key=lambda r: r.nivel, reverse=True)
+    if session.get_bind().dialect.name in _SQL_ROLLUP_DIALECTS:
+        recalculate_dotacao_exercicio_sql(session, exercicio)
+        _expire_dotacao_calculada(session)
+        return
+    
+    _recalculate_dotacao_python(session, exercicio, None)
+
+
+def _expire_dotacao_calculada(session: Session, ids: Optional[List[int]] = None) -> None:
+    """
+    Rubricas já carregadas na sessão ficaram com dotacao_calculada desatualizada
+    (todas, ou só as de ids).
+    """
+    if ids is not None:
+        for node_id in ids:
+            obj = session.identity_map.get(identity_key(Rubrica, node_id))
+            if obj is not None:
+                session.expire(obj, ["dotacao_calculada"])
+        return
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Rubrica):
+            session.expire(obj, ["dotacao_calculada"])
+
+
+def _recalculate_dotacao_python(
+    session: Session, exercicio: int, rubrica_id: Optional[int]
+) -> None:
+    """
+    Cálculo em Python: a rubrica e os seus ancestrais, ou todas as rubricas do
+    exercício quando rubrica_id é None.
+    """
+    # Árvore do exercício (ativas e inativas) em dicts simples, via SELECT de colunas:
+    # o cálculo não passa pelos atributos instrumentados do ORM
+    parent_of = {}
+    inicial_of = {}
+    # Filhos ativos por pai (apenas ativas entram na soma)
+    children_of = defaultdict(list)
+    for node_id, parent_id, status, dotacao_inicial in session.execute(
+        select(
+            Rubrica.id, Rubrica.parent_id, Rubrica.status, Rubrica.dotacao_inicial
+        ).where(Rubrica.exercicio == exercicio)
+    ):
+        parent_of[node_id] = parent_id
+        inicial_of[node_id] = dotacao_inicial
+        if status == StatusRubrica.ATIVA:
+            children_of[parent_id].append(node_id)
     
     # Cache para evitar recálculos desnecessários dentro da mesma execução
     calculated_cache = {}
     
     def calculate_node(node_id: int) -> Decimal:
         """Calcula dotacao_calculada de um nó recursivamente."""
-        # Verificar cache primeiro
         if node_id in calculated_cache:
             return calculated_cache[node_id]
         
-        node = rubricas_dict.get(node_id)
-        if not node:
-            return Decimal("0.00")
-        
-        # Buscar filhos diretos (apenas do mesmo exercício e ativos)
-        from app.models import StatusRubrica
-        children = [
-            r for r in all_rubricas 
-            if r.parent_id == node_id 
-            and r.exercicio == node.exercicio
-            and r.status == StatusRubrica.ATIVA
-        ]
-        
+        children = children_of.get(node_id)
         if children:
-            # Rubrica pai: soma das dotacoes_calculadas dos filhos
-            # IMPORTANTE: Recalcular cada filho primeiro para garantir valores atualizados
-            total = Decimal("0.00")
-            for child in children:
-                # Sempre recalcular o filho para garantir valor atualizado
-                child_calc = calculate_node(child.id)
-                # Atualizar no dicionário e no cache
-                child.dotacao_calculada = child_calc
-                calculated_cache[child.id] = child_calc
-                session.add(child)
-                total += child_calc
-            
-            node.dotacao_calculada = total
-            calculated_cache[node_id] = total
+            # Rubrica pai: soma das dotacoes_calculadas dos filhos (recalculados primeiro)
+            result = sum((calculate_node(child_id) for child_id in children), Decimal("0.00"))
         else:
-            # Rubrica folha: dotacao_calculada = dotacao_inicial
-            # dotacao_inicial é a dotação anual inicial da rubrica folha
-            # Usar getattr para evitar erro se a coluna não existir no banco
-            dotacao_inicial = getattr(node, 'dotacao_inicial', None)
+            # Rubrica folha: dotacao_calculada = dotacao_inicial (ou 0 se None)
+            dotacao_inicial = inicial_of.get(node_id)
             result = dotacao_inicial if dotacao_inicial is not None else Decimal("0.00")
-            node.dotacao_calculada = result
-            calculated_cache[node_id] = result
         
-        session.add(node)
-        return calculated_cache[node_id]
+        calculated_cache[node_id] = result
+        return result
     
-    # Calcular para todos os ancestrais
-    for ancestor in ancestors_sorted:
-        calculate_node(ancestor.id)
+    if rubrica_id is None:
+        for node_id in parent_of:
+            calculate_node(node_id)
+    else:
+        # Calcular a rubrica e todos os ancestrais, subindo pelo mapa de pais
+        node_id = rubrica_id
+        visitados = set()
+        while node_id in parent_of and node_id not in visitados:
+            visitados.add(node_id)
+            calculate_node(node_id)
+            node_id = parent_of[node_id]
     
-    session.flush()
+    # Gravar todos os valores num único UPDATE em lote (o ORM só é usado na escrita)
+    session.bulk_update_mappings(Rubrica, [
+        {"id": node_id, "dotacao_calculada": valor}
+        for node_id, valor in calculated_cache.items()
+    ])
+    # Manter os objetos já carregados na sessão coerentes com o que foi gravado
+    for node_id, valor in calculated_cache.items():
+        node = session.identity_map.get(identity_key(Rubrica, node_id))
+        if node is not None:
+            set_committed_value(node, "dotacao_calculada", valor)
 
 
 def is_leaf_rubrica(session: Session, rubrica_id: int) -> bool:
-    """Verifica se uma rubrica é folha (não tem filhos)."""
-    children = get_children(session, rubrica_id)
-    return len(children) == 0
+    """
+    Verifica se uma rubrica é folha (não tem filhos).
+    Resultado memoizado em session.info, invalidado por recalculate_dotacao_chain.
+    """
+    cache = session.info.setdefault(_LEAF_CACHE_KEY, {})
+    if rubrica_id not in cache:
+        cache[rubrica_id] = not has_children(session, rubrica_id)
+    return cache[rubrica_id]
 
 
 def has_children(session: Session, rubrica_id: int) -> bool:
-    """Verifica se uma rubrica tem filhos."""
-    return not is_leaf_rubrica(session, rubrica_id)
-
+    """Verifica se uma rubrica tem filhos (EXISTS, sem carregar as linhas)."""
+    return session.query(
+        session.query(Rubrica.id).filter(Rubrica.parent_id == rubrica_id).exists()
+    ).scalar()
@@ -4,18 +4,31 @@ Serviço para criação automática e vinculação de usuários.
 import re
 import secrets
 import string
-from typing import Optional, Dict, Any, Tuple
+import unicodedata
+from typing import Optional, Dict, Any, List, Tuple
+from sqlalchemy import insert, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from app.models import Usuario, UserCreationLog
 from app.crud import get_password_hash
+from app.config import settings
+
+# Padrões compilados uma vez (usados em loops de criação em lote)
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_USERNAME_INVALID_RE = re.compile(r'[^a-z0-9_]')
+
+# Acentos comuns em português (já em minúsculas) -> ASCII
+_ACCENT_TBL = str.maketrans(
+    'áàâãäéèêëíìîïóòôõöúùûüç',
+    'aaaaaeeeeiiiiooooouuuuc'
+)
 
 
 def is_valid_email(email: str) -> bool:
     """Valida formato de email."""
     if not email or not isinstance(email, str):
         return False
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email.strip()))
+    return _EMAIL_RE.match(email.strip()) is not None
 
 
 def generate_username_from_email(email: str) -> str:
@@ -24,7 +37,7 @@ def generate_username_from_email(email: str) -> str:
         return ""
     username = email.split('@')[0].lower()
     # Remover caracteres inválidos
-    username = re.sub(r'[^a-z0-9_]', '', username)
+    username = _USERNAME_INVALID_RE.sub('', username)
     # Limitar tamanho
     return username[:50]
 
@@ -35,14 +48,25 @@ def generate_username_from_nome(nome: str) -> str:
         return "user"
     # Converter para lowercase e substituir espaços por underscore
     username = nome.lower().strip().replace(" ", "_")
-    # Remover caracteres especiais e acentos
-    import unicodedata
-    username = unicodedata.normalize('NFKD', username).encode('ascii', 'ignore').decode('ascii')
-    username = re.sub(r'[^a-z0-9_]', '', username)
+    # Remover acentos (tabela para os casos comuns, NFKD só se restar algo não-ASCII)
+    username = username.translate(_ACCENT_TBL)
+    if not username.isascii():
+        username = unicodedata.normalize('NFKD', username).encode('ascii', 'ignore').decode('ascii')
+    # Remover caracteres especiais
+    username = _USERNAME_INVALID_RE.sub('', username)
     # Limitar tamanho
     return username[:50] if username else "user"
 
 
+def _make_temp_email(nome: str) -> str:
+    """
+    Email temporário derivado do nome (para entidades sem email válido).
+    A parte local é normalizada como o username (sem acentos nem caracteres
+    especiais), para que o email passe em is_valid_email.
+    """
+    return f"{generate_username_from_nome(nome)}@temp.local"
+
+
 def generate_temporary_password(length: int = 12) -> str:
     """Gera senha temporária segura."""
     alphabet = string.ascii_letters + string.digits + "!@#$%&*"
@@ -71,15 +95,57 @@ def find_existing_user_by_contacto(db: Session, contacto: str) -> Optional[Usuar
     return db.query(Usuario).filter(Usuario.contacto == contacto.strip()).first()
 
 
+def find_existing_user(
+    db: Session,
+    email: Optional[str] = None,
+    nuit: Optional[str] = None,
+    contacto: Optional[str] = None
+) -> Tuple[Optional[Usuario], Optional[str]]:
+    """
+    Busca usuário existente por email, NUIT ou contacto numa única consulta (OR).
+    
+    Prioridade: email > nuit > contacto.
+    Retorna: (usuario, metodo_busca)
+    """
+    criterios = []
+    if email and is_valid_email(email):
+        criterios.append(("email", Usuario.email, email.strip().lower()))
+    if nuit and nuit.strip():
+        criterios.append(("nuit", Usuario.nuit, nuit.strip()))
+    if contacto and contacto.strip():
+        criterios.append(("contacto", Usuario.contacto, contacto.strip()))
+    
+    if not criterios:
+        return None, None
+    
+    candidatos = db.query(Usuario).filter(
+        or_(*[coluna == valor for _, coluna, valor in criterios])
+    ).order_by(Usuario.id).all()
+    
+    for metodo, coluna, valor in criterios:
+        for usuario in candidatos:
+            if getattr(usuario, coluna.key) == valor:
+                return usuario, metodo
+    return None, None
+
+
 def create_unique_username(db: Session, base_username: str) -> str:
     """Cria username único, adicionando sufixo numérico se necessário."""
     if not base_username:
         base_username = "user"
     
+    # Todos os usernames que podem colidir, numa só consulta (candidatos começam por
+    # base_username[:96]; "_" do LIKE só alarga o conjunto, a verificação é exata)
+    taken = {
+        row[0] for row in db.query(Usuario.username).filter(
+            Usuario.username.like(f"{base_username[:96]}%")
+        ).all()
+    }
+    
     username = base_username
     counter = 1
     
-    while db.query(Usuario).filter(Usuario.username == username).first() is not None:
+    while username in taken:
         suffix = f"{counter}"
         max_len = 100 - len(suffix)
         username = base_username[:max_len] + suffix
@@ -97,7 +163,7 @@ def create_user_automatically(
     contacto: Optional[str] = None,
     nuit: Optional[str] = None,
     endereco: Optional[str] = None
-) -> Tuple[Usuario, str]:
+) -> Tuple[Usuario, Optional[str]]:
     """
     Cria usuário automaticamente com senha temporária.
     
@@ -106,7 +172,8 @@ def create_user_automatically(
         nome: Nome completo (obrigatório)
     
     Returns:
-        Tuple[Usuario, str]: (usuario_criado, senha_temporaria)
+        Tuple[Usuario, Optional[str]]: (usuario_criado, senha_temporaria);
+        senha_temporaria é None se já existia usuário com o mesmo email
     """
     if not nome or not nome.strip():
         raise ValueError("Nome é obrigatório para criar usuário automaticamente.")
@@ -122,32 +189,56 @@ def create_user_automatically(
     
     username = create_unique_username(db, base_username)
     
-    # Gerar senha temporária
-    senha_temporaria = generate_temporary_password()
-    
     # Normalizar email (usar email fornecido ou gerar temporário)
     email_normalizado = None
     if email and is_valid_email(email):
         email_normalizado = email.strip().lower()
     # Se não tiver email válido, não definir (pode ser NULL)
     
-    # Criar usuário
-    usuario = Usuario(
-        username=username,
-        senha=get_password_hash(senha_temporaria),
-        nome=nome.strip(),
-        email=email_normalizado,
-        contacto=contacto,
-        nuit=nuit,
-        endereco=endereco,
-        activo=True,
-        must_change_password=True
+    # Gerar senha temporária e o hash (bcrypt é caro) só quando a inserção é certa
+    senha_temporaria = generate_temporary_password()
+    senha_hash = get_password_hash(
+        senha_temporaria, rounds=settings.TEMP_PASSWORD_BCRYPT_ROUNDS
     )
     
-    db.add(usuario)
-    db.flush()
-    
-    return usuario, senha_temporaria
+    # Criar usuário; se o email já existir (ex: criado em paralelo), a inserção é
+    # desfeita e devolve-se o usuário existente, sem senha temporária
+    usuario_id = _insert_usuario_ignore_duplicate(db, {
+        "username": username,
+        "senha": senha_hash,
+        "nome": nome.strip(),
+        "email": email_normalizado,
+        "contacto": contacto,
+        "nuit": nuit,
+        "endereco": endereco,
+        "activo": True,
+        "must_change_password": True
+    })
+    
+    if usuario_id is None:
+        usuario_existente = find_existing_user_by_email(db, email_normalizado) if email_normalizado else None
+        if not usuario_existente:
+            raise ValueError("Não foi possível criar usuário: dados únicos já em uso.")
+        return usuario_existente, None
+    
+    return db.get(Usuario, usuario_id), senha_temporaria
+
+
+def _insert_usuario_ignore_duplicate(db: Session, valores: Dict[str, Any]) -> Optional[int]:
+    """
+    Insere usuário num SAVEPOINT. Se o INSERT falhar porque o email já existe (ex:
+    criado em paralelo), desfaz só o SAVEPOINT e retorna None; qualquer outro
+    conflito (username, nuit, contacto) ou erro de dados é propagado.
+    Retorna o id inserido.
+    """
+    try:
+        with db.begin_nested():
+            result = db.execute(insert(Usuario.__table__).values(**valores))
+    except IntegrityError:
+        if find_existing_user_by_email(db, valores.get("email")):
+            return None
+        raise
+    return result.inserted_primary_key[0]
 
 
 def handle_user_creation_for_fornecedor(
@@ -182,26 +273,10 @@ def handle_user_creation_for_fornecedor(
     nif = getattr(fornecedor_data, 'nif', None)
     endereco = getattr(fornecedor_data, 'endereco', None)
     
-    # PASSO 1: Procurar por email
-    usuario_existente = None
-    metodo_busca = None
-    
-    if email and is_valid_email(email):
-        usuario_existente = find_existing_user_by_email(db, email)
-        if usuario_existente:
-            metodo_busca = "email"
-    
-    # PASSO 2: Se não encontrou por email, tentar NUIT
-    if not usuario_existente and nif:
-        usuario_existente = find_existing_user_by_nuit(db, nif)
-        if usuario_existente:
-            metodo_busca = "nuit"
-    
-    # PASSO 3: Se não encontrou, tentar contacto
-    if not usuario_existente and contacto:
-        usuario_existente = find_existing_user_by_contacto(db, contacto)
-        if usuario_existente:
-            metodo_busca = "contacto"
+    # Procurar por email, NUIT ou contacto (por esta ordem de prioridade)
+    usuario_existente, metodo_busca = find_existing_user(
+        db, email=email, nuit=nif, contacto=contacto
+    )
     
     # Se encontrou usuário existente
     if usuario_existente:
@@ -220,7 +295,7 @@ def handle_user_creation_for_fornecedor(
     
     # Se não tiver email válido, gerar email temporário e verificar se já existe
     if not email_para_criacao:
-        email_temp = f"{nome.lower().replace(' ', '_')}@temp.local"
+        email_para_criacao = email_temp = _make_temp_email(nome)
         # Verificar se o email temporário já existe
         usuario_temp = find_existing_user_by_email(db, email_temp)
         if usuario_temp:
@@ -236,9 +311,18 @@ def handle_user_creation_for_fornecedor(
     
     try:
         novo_usuario, senha_temporaria = create_user_automatically(
-            db, email_para_criacao or f"{nome.lower().replace(' ', '_')}@temp.local", 
-            nome, contacto, nif, endereco
+            db, email_para_criacao, nome, contacto, nif, endereco
         )
+        if senha_temporaria is None:
+            # Email já existia: vincular ao usuário existente
+            resultado["usuario_vinculado"] = True
+            resultado["vinculado"] = True
+            resultado["usuario_id"] = novo_usuario.id
+            resultado["username"] = novo_usuario.username
+            resultado["mensagem"] = f"Usuário existente vinculado (email: {novo_usuario.email})."
+            log_user_creation(db, novo_usuario.id, "fornecedor", fornecedor_id, 
+                             "Usuário existente vinculado via email")
+            return resultado
         resultado["usuario_criado"] = True
         resultado["vinculado"] = False
         resultado["usuario_id"] = novo_usuario.id
@@ -248,21 +332,6 @@ def handle_user_creation_for_fornecedor(
         log_user_creation(db, novo_usuario.id, "fornecedor", fornecedor_id, 
                        "Usuário criado automaticamente")
     except Exception as e:
-        # Se erro de integridade (email duplicado), tentar buscar o usuário existente
-        if "Duplicate entry" in str(e) and "email" in str(e):
-            db.rollback()
-            # Tentar buscar por email temporário
-            email_temp = f"{nome.lower().replace(' ', '_')}@temp.local"
-            usuario_existente = find_existing_user_by_email(db, email_temp)
-            if usuario_existente:
-                resultado["usuario_vinculado"] = True
-                resultado["vinculado"] = True
-                resultado["usuario_id"] = usuario_existente.id
-                resultado["username"] = usuario_existente.username
-                resultado["mensagem"] = f"Usuário existente vinculado (email temporário: {email_temp})."
-                log_user_creation(db, usuario_existente.id, "fornecedor", fornecedor_id, 
-                                 f"Usuário existente vinculado via email temporário (após erro de duplicação)")
-                return resultado
         log_user_creation(db, None, "fornecedor", fornecedor_id, f"Erro ao criar usuário: {str(e)}")
         raise ValueError(f"Erro ao criar usuário: {str(e)}")
     
@@ -299,20 +368,10 @@ def handle_user_creation_for_funcionario(
     email = getattr(funcionario_data, 'email', None) or getattr(funcionario_data, 'email_usuario', None)
     contacto = getattr(funcionario_data, 'contacto', None)
     
-    # PASSO 1: Procurar por email
-    usuario_existente = None
-    metodo_busca = None
-    
-    if email and is_valid_email(email):
-        usuario_existente = find_existing_user_by_email(db, email)
-        if usuario_existente:
-            metodo_busca = "email"
-    
-    # PASSO 2: Se não encontrou, tentar contacto
-    if not usuario_existente and contacto:
-        usuario_existente = find_existing_user_by_contacto(db, contacto)
-        if usuario_existente:
-            metodo_busca = "contacto"
+    # Procurar por email ou contacto (por esta ordem de prioridade)
+    usuario_existente, metodo_busca = find_existing_user(
+        db, email=email, contacto=contacto
+    )
     
     # Se encontrou usuário existente
     if usuario_existente:
@@ -331,7 +390,7 @@ def handle_user_creation_for_funcionario(
     
     # Se não tiver email válido, gerar email temporário e verificar se já existe
     if not email_para_criacao:
-        email_temp = f"{nome.lower().replace(' ', '_')}@temp.local"
+        email_para_criacao = email_temp = _make_temp_email(nome)
         # Verificar se o email temporário já existe
         usuario_temp = find_existing_user_by_email(db, email_temp)
         if usuario_temp:
@@ -347,9 +406,18 @@ def handle_user_creation_for_funcionario(
     
     try:
         novo_usuario, senha_temporaria = create_user_automatically(
-            db, email_para_criacao or f"{nome.lower().replace(' ', '_')}@temp.local", 
-            nome, contacto, None, None
+            db, email_para_criacao, nome, contacto, None, None
         )
+        if senha_temporaria is None:
+            # Email já existia: vincular ao usuário existente
+            resultado["usuario_vinculado"] = True
+            resultado["vinculado"] = True
+            resultado["usuario_id"] = novo_usuario.id
+            resultado["username"] = novo_usuario.username
+            resultado["mensagem"] = f"Usuário existente vinculado (email: {novo_usuario.email})."
+            log_user_creation(db, novo_usuario.id, "funcionario", funcionario_id, 
+                             "Usuário existente vinculado via email")
+            return resultado
         resultado["usuario_criado"] = True
         resultado["vinculado"] = False
         resultado["usuario_id"] = novo_usuario.id
@@ -359,21 +427,6 @@ def handle_user_creation_for_funcionario(
         log_user_creation(db, novo_usuario.id, "funcionario", funcionario_id, 
                        "Usuário criado automaticamente")
     except Exception as e:
-        # Se erro de integridade (email duplicado), tentar buscar o usuário existente
-        if "Duplicate entry" in str(e) and "email" in str(e):
-            db.rollback()
-            # Tentar buscar por email temporário
-            email_temp = f"{nome.lower().replace(' ', '_')}@temp.local"
-            usuario_existente = find_existing_user_by_email(db, email_temp)
-            if usuario_existente:
-                resultado["usuario_vinculado"] = True
-                resultado["vinculado"] = True
-                resultado["usuario_id"] = usuario_existente.id
-                resultado["username"] = usuario_existente.username
-                resultado["mensagem"] = f"Usuário existente vinculado (email temporário: {email_temp})."
-                log_user_creation(db, usuario_existente.id, "funcionario", funcionario_id, 
-                                 f"Usuário existente vinculado via email temporário (após erro de duplicação)")
-                return resultado
         log_user_creation(db, None, "funcionario", funcionario_id, f"Erro ao criar usuário: {str(e)}")
         raise ValueError(f"Erro ao criar usuário: {str(e)}")
     
@@ -387,7 +440,7 @@ def log_user_creation(
     ref_id: int,
     detalhes: str
 ) -> None:
-    """Registra log de criação/vínculo de usuário."""
+    """Registra log de criação/vínculo de usuário (gravado no próximo flush/commit)."""
     log = UserCreationLog(
         usuario_id=usuario_id,
         tipo=tipo,
@@ -395,5 +448,14 @@ def log_user_creation(
         detalhes=detalhes
     )
     db.add(log)
-    db.flush()
+
+
+def log_user_creations(db: Session, entries: List[Dict[str, Any]]) -> None:
+    """
+    Registra vários logs de criação/vínculo numa só instrução.
+    
+    Cada entrada: {"usuario_id", "tipo", "ref_id", "detalhes"}
+    """
+    if entries:
+        db.bulk_insert_mappings(UserCreationLog, entries)
 
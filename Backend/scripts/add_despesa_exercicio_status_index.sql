@@ -0,0 +1,9 @@
+-- Script para adicionar índice composto em despesa (exercicio, status, rubrica_id, mes)
+-- Os scripts de execução mensal e os agregados filtram despesas confirmadas de um
+-- exercício e agrupam por (rubrica_id, mes); os índices isolados em exercicio e
+-- status não servem esse filtro+agrupamento.
+-- execucao_mensal já tem o índice único uq_execucao_rubrica_mes_ano (rubrica_id, mes, ano).
+
+USE sistema_contabil;
+
+CREATE INDEX idx_despesa_exercicio_status ON despesa (exercicio, status, rubrica_id, mes);
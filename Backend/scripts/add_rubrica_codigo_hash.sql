@@ -0,0 +1,22 @@
+-- Script para adicionar coluna codigo_hash à tabela rubrica
+-- Hash de 8 bytes de (codigo, exercicio) usado para lookup com chave curta.
+-- Deve coincidir com app.models.compute_codigo_hash:
+--   sha256(f"{codigo}:{exercicio}")[:8]
+
+USE sistema_contabil;
+
+-- Adicionar coluna (nullable para permitir o preenchimento inicial)
+ALTER TABLE rubrica
+ADD COLUMN IF NOT EXISTS codigo_hash BINARY(8) NULL AFTER status;
+
+-- Preencher codigo_hash para as rubricas existentes
+UPDATE rubrica
+SET codigo_hash = UNHEX(LEFT(SHA2(CONCAT(codigo, ':', exercicio), 256), 16))
+WHERE codigo_hash IS NULL;
+
+-- Tornar obrigatória e única
+ALTER TABLE rubrica
+MODIFY COLUMN codigo_hash BINARY(8) NOT NULL;
+
+ALTER TABLE rubrica
+ADD UNIQUE KEY uq_rubrica_codigo_hash (codigo_hash);
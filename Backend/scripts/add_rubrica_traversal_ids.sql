@@ -0,0 +1,40 @@
+-- Script para adicionar coluna traversal_ids à tabela rubrica
+-- Caminho materializado: array JSON com os ids dos ancestrais, da raiz até ao pai.
+-- Mantido pelos eventos de app.models (_set_rubrica_traversal_ids /
+-- _update_rubrica_traversal_ids); substitui os CTE recursivos em
+-- get_ancestors / get_all_descendants.
+-- Alvo: MariaDB 10.2+ (como os outros scripts, usa ADD COLUMN IF NOT EXISTS).
+
+USE sistema_contabil;
+
+-- Adicionar coluna (nullable para permitir o preenchimento inicial)
+ALTER TABLE rubrica
+ADD COLUMN IF NOT EXISTS traversal_ids JSON NULL AFTER nivel;
+
+-- Preencher traversal_ids para as rubricas existentes
+UPDATE rubrica r
+INNER JOIN (
+    WITH RECURSIVE caminhos (id, path) AS (
+        -- O tipo da coluna do CTE vem do membro âncora: CHAR largo para caber o caminho
+        SELECT id, CAST('[]' AS CHAR(4000))
+        FROM rubrica
+        WHERE parent_id IS NULL
+        
+        UNION ALL
+        
+        SELECT c.id, JSON_ARRAY_APPEND(p.path, '$', p.id)
+        FROM rubrica c
+        INNER JOIN caminhos p ON c.parent_id = p.id
+    )
+    SELECT id, path FROM caminhos
+) t ON t.id = r.id
+SET r.traversal_ids = t.path;
+
+-- Tornar obrigatória
+ALTER TABLE rubrica
+MODIFY COLUMN traversal_ids JSON NOT NULL;
+
+-- Sem índice em traversal_ids: o MariaDB não tem índices multi-valor
+-- (CAST(... AS UNSIGNED ARRAY) é só do MySQL 8.0.17+) e traversal_contains usa lá
+-- JSON_CONTAINS, que não aproveitaria esse índice (a procura de descendentes
+-- percorre a tabela rubrica).
@@ -1,7 +1,9 @@
 """
 Script para criar usuário administrador inicial.
 Execute: python scripts/create_admin.py
+   ou:   python scripts/create_admin.py --username admin --password ... --nome "..." [--email ...]
 """
+import argparse
 import sys
 from pathlib import Path
 
@@ -9,68 +11,93 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from app.db import SessionLocal
-from app.crud import create_usuario, assign_papel_to_usuario, create_papel, get_papel_by_nome
-from app.schemas import UsuarioCreate, PapelCreate
+from app.crud import get_usuario_by_username, get_password_hash
+from app.models import Papel, Usuario, UsuarioPapel
 
+PAPEIS = {
+    "admin": "Administrador do sistema",
+    "contabilista": "Contabilista - pode importar e confirmar despesas",
+    "visualizador": "Visualizador - apenas leitura",
+}
 
-def main():
+
+def parse_args(argv=None):
+    """Argumentos de linha de comando (para uso não interativo)."""
+    parser = argparse.ArgumentParser(description="Cria usuário admin e papéis básicos.")
+    parser.add_argument("--username", help="Username do admin (padrão: admin)")
+    parser.add_argument("--password", help="Senha do admin (padrão: admin123)")
+    parser.add_argument("--nome", help="Nome do admin (padrão: Administrador)")
+    parser.add_argument("--email", help="Email do admin (opcional)")
+    return parser.parse_args(argv)
+
+
+def _valor(arg, pergunta, padrao):
+    """Usa o argumento; sem ele, pergunta só se houver terminal, senão usa o padrão."""
+    if arg is not None:
+        return arg.strip() or padrao
+    if sys.stdin.isatty():
+        return input(pergunta).strip() or padrao
+    return padrao
+
+
+def main(argv=None):
     """Cria usuário admin e papéis básicos."""
+    args = parse_args(argv)
+    
+    # Obter os dados antes de abrir a transação
+    username = _valor(args.username, "Digite o username do admin (ou Enter para 'admin'): ", "admin")
+    senha = _valor(args.password, "Digite a senha do admin (ou Enter para 'admin123'): ", "admin123")
+    nome = _valor(args.nome, "Digite o nome do admin (ou Enter para 'Administrador'): ", "Administrador")
+    email = _valor(args.email, "Digite o email (ou Enter para pular): ", None)
+    
     db = SessionLocal()
     
     try:
-        # Criar papéis se não existirem
-        papeis = ["admin", "contabilista", "visualizador"]
-        papel_ids = {}
-        
-        for papel_nome in papeis:
-            papel = get_papel_by_nome(db, papel_nome)
-            if not papel:
-                if papel_nome == "admin":
-                    descricao = "Administrador do sistema"
-                elif papel_nome == "contabilista":
-                    descricao = "Contabilista - pode importar e confirmar despesas"
-                else:
-                    descricao = "Visualizador - apenas leitura"
-                
-                papel = create_papel(db, PapelCreate(nome=papel_nome, descricao=descricao))
+        # Uma única transação (commit no fim do bloco), sem flushes automáticos
+        with db.begin(), db.no_autoflush:
+            # Criar papéis se não existirem (os três buscados numa só consulta)
+            papeis = {
+                p.nome: p for p in db.query(Papel).filter(Papel.nome.in_(PAPEIS)).all()
+            }
+            for papel_nome, descricao in PAPEIS.items():
+                if papel_nome in papeis:
+                    print(f"[OK] Papel '{papel_nome}' ja existe")
+                    continue
+                papeis[papel_nome] = Papel(nome=papel_nome, descricao=descricao)
+                db.add(papeis[papel_nome])
                 print(f"[OK] Papel '{papel_nome}' criado")
+            
+            # Criar usuário admin
+            usuario = get_usuario_by_username(db, username)
+            if usuario:
+                print(f"[AVISO] Usuario '{username}' ja existe. Atualizando senha...")
+                usuario.senha = get_password_hash(senha)
+                usuario.activo = True
+                if email:
+                    usuario.email = email
             else:
-                print(f"[OK] Papel '{papel_nome}' ja existe")
+                usuario = Usuario(
+                    username=username,
+                    senha=get_password_hash(senha),
+                    nome=nome,
+                    email=email,
+                    activo=True
+                )
+                db.add(usuario)
+                print(f"[OK] Usuario '{username}' criado")
             
-            papel_ids[papel_nome] = papel.id
-        
-        # Criar usuário admin
-        username = input("Digite o username do admin (ou Enter para 'admin'): ").strip() or "admin"
-        senha = input("Digite a senha do admin (ou Enter para 'admin123'): ").strip() or "admin123"
-        nome = input("Digite o nome do admin (ou Enter para 'Administrador'): ").strip() or "Administrador"
-        email = input("Digite o email (ou Enter para pular): ").strip() or None
-        
-        from app.crud import get_usuario_by_username, get_password_hash
-        existing = get_usuario_by_username(db, username)
-        if existing:
-            print(f"[AVISO] Usuario '{username}' ja existe. Atualizando senha...")
-            existing.senha = get_password_hash(senha)
-            existing.activo = True
-            if email:
-                existing.email = email
-            db.commit()
-            db.refresh(existing)
-            usuario = existing
-        else:
-            usuario_data = UsuarioCreate(
-                username=username,
-                senha=senha,
-                nome=nome,
-                activo=True
-            )
-            if email:
-                usuario_data.email = email
-            usuario = create_usuario(db, usuario_data)
-            print(f"[OK] Usuario '{username}' criado")
-        
-        # Atribuir papel admin
-        assign_papel_to_usuario(db, usuario.id, papel_ids["admin"], usuario.id)
-        print(f"[OK] Papel 'admin' atribuido ao usuario '{username}'")
+            # Um flush para obter os ids dos novos papéis/usuário
+            db.flush()
+            
+            # Atribuir papel admin
+            papel_admin_id = papeis["admin"].id
+            if not db.get(UsuarioPapel, (usuario.id, papel_admin_id)):
+                db.add(UsuarioPapel(
+                    usuario_id=usuario.id,
+                    papel_id=papel_admin_id,
+                    atribuido_por=usuario.id
+                ))
+            print(f"[OK] Papel 'admin' atribuido ao usuario '{username}'")
         
         print("\n[OK] Setup concluido!")
         print(f"   Username: {username}")
@@ -79,11 +106,9 @@ def main():
         
     except Exception as e:
         print(f"[ERRO] Erro: {str(e)}")
-        db.rollback()
     finally:
         db.close()
 
 
 if __name__ == "__main__":
     main()
-
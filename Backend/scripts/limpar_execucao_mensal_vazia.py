@@ -9,7 +9,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.db import SessionLocal
 from app.models import ExecucaoMensal, Despesa, StatusDespesa
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, select, update, delete, exists
 from decimal import Decimal
 
 def limpar_execucao_mensal_vazia(exercicio: int = 2025):
@@ -23,50 +23,52 @@ def limpar_execucao_mensal_vazia(exercicio: int = 2025):
         print("=" * 60)
         
         # Contar registros antes
-        total_antes = db.query(ExecucaoMensal).filter(
+        total_antes = db.query(func.count(ExecucaoMensal.id)).filter(
             ExecucaoMensal.ano == exercicio
-        ).count()
+        ).scalar()
         print(f"\nRegistros existentes antes: {total_antes}")
         
-        # Buscar todos os registros do exercício
-        execucoes = db.query(ExecucaoMensal).filter(
-            ExecucaoMensal.ano == exercicio
-        ).all()
-        
-        removidos = 0
-        mantidos = 0
+        # Despesas confirmadas da mesma rubrica/mês (subconsultas correlacionadas)
+        despesas_confirmadas = and_(
+            Despesa.rubrica_id == ExecucaoMensal.rubrica_id,
+            Despesa.mes == ExecucaoMensal.mes,
+            Despesa.exercicio == exercicio,
+            Despesa.status == StatusDespesa.CONFIRMADA
+        )
+        gasto_real = func.coalesce(
+            select(func.sum(Despesa.valor)).where(despesas_confirmadas).scalar_subquery(),
+            Decimal("0.00")
+        )
         
         print("\nVerificando registros...")
-        for exec in execucoes:
-            # Verificar se há despesas confirmadas para este mês/rubrica
-            gasto_real = db.query(func.sum(Despesa.valor)).filter(
-                and_(
-                    Despesa.rubrica_id == exec.rubrica_id,
-                    Despesa.mes == exec.mes,
-                    Despesa.exercicio == exercicio,
-                    Despesa.status == StatusDespesa.CONFIRMADA
-                )
-            ).scalar() or Decimal("0.00")
-            
-            # Se não há gasto real (sem despesas confirmadas), remover
-            if gasto_real == 0 and exec.gasto == 0:
-                print(f"  Removendo: Rubrica {exec.rubrica_id}, Mês {exec.mes} (sem despesas confirmadas)")
-                db.delete(exec)
-                removidos += 1
-            else:
-                # Atualizar gasto e saldo se necessário
-                if exec.gasto != gasto_real:
-                    exec.gasto = gasto_real
-                    exec.saldo = exec.dotacao - gasto_real
-                    print(f"  Atualizando: Rubrica {exec.rubrica_id}, Mês {exec.mes} (gasto: {exec.gasto})")
-                mantidos += 1
+        # Remover registros sem gasto e sem despesas confirmadas (um DELETE)
+        removidos = db.execute(
+            delete(ExecucaoMensal).where(
+                ExecucaoMensal.ano == exercicio,
+                ExecucaoMensal.gasto == 0,
+                ~exists().where(despesas_confirmadas)
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        
+        # Atualizar gasto e saldo dos restantes onde divergem (um UPDATE)
+        atualizados = db.execute(
+            update(ExecucaoMensal).where(
+                ExecucaoMensal.ano == exercicio,
+                ExecucaoMensal.gasto != gasto_real
+            ).values(
+                gasto=gasto_real,
+                saldo=ExecucaoMensal.dotacao - gasto_real
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        
+        mantidos = total_antes - removidos
+        print(f"  Removidos: {removidos} (sem despesas confirmadas)")
+        print(f"  Atualizados: {atualizados} (gasto/saldo recalculados)")
         
         db.commit()
         
-        # Contar registros depois
-        total_depois = db.query(ExecucaoMensal).filter(
-            ExecucaoMensal.ano == exercicio
-        ).count()
+        # Registros depois = antes - removidos (o UPDATE não altera a contagem)
+        total_depois = total_antes - removidos
         
         print("\n" + "=" * 60)
         print("RESUMO")
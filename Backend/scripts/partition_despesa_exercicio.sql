@@ -0,0 +1,51 @@
+-- Script para particionar a tabela despesa por exercício (RANGE)
+-- As consultas filtram sempre por exercicio, pelo que o otimizador passa a ler
+-- apenas a partição do ano pedido (partition pruning).
+--
+-- Restrições do MySQL para tabelas particionadas:
+--   * todas as chaves únicas (incluindo a PK) devem conter a coluna de partição;
+--   * InnoDB não suporta chaves estrangeiras em tabelas particionadas.
+-- A integridade referencial de rubrica_id/fornecedor_id/batch_id passa a ser
+-- garantida pela aplicação (os relacionamentos ORM continuam a funcionar).
+
+USE sistema_contabil;
+
+-- 1. Remover chaves estrangeiras
+ALTER TABLE despesa DROP FOREIGN KEY fk_despesa_rubrica;
+ALTER TABLE despesa DROP FOREIGN KEY fk_despesa_fornecedor;
+ALTER TABLE despesa DROP FOREIGN KEY fk_despesa_batch;
+
+-- 2. exercicio obrigatório e incluído na chave primária
+ALTER TABLE despesa MODIFY COLUMN exercicio SMALLINT NOT NULL;
+ALTER TABLE despesa DROP PRIMARY KEY, ADD PRIMARY KEY (id, exercicio);
+
+-- 3. Particionar por exercício
+ALTER TABLE despesa
+PARTITION BY RANGE (exercicio) (
+  PARTITION p2022 VALUES LESS THAN (2023),
+  PARTITION p2023 VALUES LESS THAN (2024),
+  PARTITION p2024 VALUES LESS THAN (2025),
+  PARTITION p2025 VALUES LESS THAN (2026),
+  PARTITION p2026 VALUES LESS THAN (2027),
+  PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Rollover anual (fazer antes de 1 de janeiro de cada novo exercício):
+-- as partições p2022..p2026 são fixas; um exercício sem partição própria cai em
+-- pmax (continua a funcionar, mas sem pruning por ano). Para abrir o exercício N,
+-- dividir pmax (operação rápida enquanto pmax estiver vazia):
+-- ALTER TABLE despesa REORGANIZE PARTITION pmax INTO (
+--   PARTITION p2027 VALUES LESS THAN (2028),
+--   PARTITION pmax VALUES LESS THAN MAXVALUE
+-- );
+-- Consultar as partições existentes:
+-- SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS
+--   FROM INFORMATION_SCHEMA.PARTITIONS
+--  WHERE TABLE_SCHEMA = 'sistema_contabil' AND TABLE_NAME = 'despesa';
+--
+-- O modelo SQLAlchemy (app/models.py) não declara o particionamento: create_all
+-- cria a tabela sem partições (com FKs e PK em id); este script é o único
+-- caminho para particionar uma base existente.
+
+-- Verificar pruning:
+-- EXPLAIN SELECT SUM(valor) FROM despesa WHERE exercicio = 2025;
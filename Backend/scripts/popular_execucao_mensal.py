@@ -10,9 +10,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.db import SessionLocal
 from app.models import ExecucaoMensal, Rubrica, Despesa, StatusDespesa, StatusRubrica
-from app.services.rubrica_service import recalculate_dotacao_chain
-from app.crud import recalculate_execucao_mensal
-from sqlalchemy import func, and_
+from app.services.rubrica_service import recalculate_dotacao_exercicio_sql
+from sqlalchemy import func
 from decimal import Decimal
 
 def popular_execucao_mensal_script(exercicio: int = 2025):
@@ -25,55 +24,47 @@ def popular_execucao_mensal_script(exercicio: int = 2025):
         print(f"Popular Execução Mensal - Exercício {exercicio}")
         print("=" * 60)
         
-        # Verificar estado antes
-        count_antes = db.query(ExecucaoMensal).filter(
-            ExecucaoMensal.ano == exercicio
-        ).count()
+        # Execuções já existentes do exercício (a contagem "antes" sai desta mesma consulta)
+        existentes = {
+            (rubrica_id, mes): (execucao_id, dotacao)
+            for execucao_id, rubrica_id, mes, dotacao in db.query(
+                ExecucaoMensal.id, ExecucaoMensal.rubrica_id,
+                ExecucaoMensal.mes, ExecucaoMensal.dotacao
+            ).filter(ExecucaoMensal.ano == exercicio).all()
+        }
+        count_antes = len(existentes)
         print(f"\nRegistros existentes antes: {count_antes}")
         
-        # Buscar todas as rubricas ativas do exercício
-        rubricas = db.query(Rubrica).filter(
+        # Contar as rubricas ativas do exercício (sem carregar os objetos)
+        total_rubricas = db.query(func.count(Rubrica.id)).filter(
             Rubrica.exercicio == exercicio,
             Rubrica.status == StatusRubrica.ATIVA
-        ).all()
+        ).scalar()
         
-        if not rubricas:
+        if not total_rubricas:
             print(f"\n❌ Nenhuma rubrica ativa encontrada para o exercício {exercicio}")
             return False
         
-        print(f"Rubricas encontradas: {len(rubricas)}")
+        print(f"Rubricas encontradas: {total_rubricas}")
         
         # Primeiro, garantir que dotacao_calculada está atualizada
+        # (todo o exercício em SQL: folhas e depois cada nível, do mais profundo para o topo)
         print("\n1. Recalculando dotacao_calculada para todas as rubricas...")
-        rubricas_ordenadas = sorted(rubricas, key=lambda r: r.nivel, reverse=True)
-        for i, rubrica in enumerate(rubricas_ordenadas, 1):
-            try:
-                recalculate_dotacao_chain(db, rubrica.id)
-                if i % 50 == 0:
-                    print(f"   Processadas {i}/{len(rubricas_ordenadas)} rubricas...")
-            except Exception as e:
-                print(f"   ⚠️  Erro ao recalcular dotação para rubrica {rubrica.id}: {e}")
-        db.commit()
-        print(f"   ✅ Dotação recalculada para {len(rubricas_ordenadas)} rubricas")
-        
-        # Buscar todas as despesas confirmadas do exercício
-        print("\n2. Buscando despesas confirmadas...")
-        despesas_confirmadas = db.query(Despesa).filter(
+        # Sem commit aqui: os valores já são visíveis na mesma transação (commit único no fim)
+        recalculate_dotacao_exercicio_sql(db, exercicio)
+        print(f"   ✅ Dotação recalculada para {total_rubricas} rubricas")
+        
+        # Gasto por (rubrica, mês) agregado na base de dados (GROUP BY)
+        print("\n2. Agregando despesas confirmadas por rubrica/mês...")
+        gastos = db.query(
+            Despesa.rubrica_id, Despesa.mes, func.sum(Despesa.valor)
+        ).filter(
             Despesa.exercicio == exercicio,
             Despesa.status == StatusDespesa.CONFIRMADA,
             Despesa.rubrica_id.isnot(None)
-        ).all()
-        print(f"   Despesas confirmadas encontradas: {len(despesas_confirmadas)}")
-        
-        # Agrupar despesas por (rubrica_id, mes)
-        despesas_por_rubrica_mes = {}
-        for despesa in despesas_confirmadas:
-            key = (despesa.rubrica_id, despesa.mes)
-            if key not in despesas_por_rubrica_mes:
-                despesas_por_rubrica_mes[key] = []
-            despesas_por_rubrica_mes[key].append(despesa)
+        ).group_by(Despesa.rubrica_id, Despesa.mes).all()
         
-        print(f"   Combinações (rubrica, mês) com despesas: {len(despesas_por_rubrica_mes)}")
+        print(f"   Combinações (rubrica, mês) com despesas: {len(gastos)}")
         
         # Criar/atualizar execucao_mensal APENAS para combinações (rubrica, mês) que têm despesas confirmadas
         print("\n3. Criando/atualizando execucao_mensal APENAS para rubricas/meses com despesas confirmadas...")
@@ -81,36 +72,54 @@ def popular_execucao_mensal_script(exercicio: int = 2025):
         atualizadas = 0
         erros = []
         
-        for (rubrica_id, mes), despesas_list in despesas_por_rubrica_mes.items():
-            try:
-                # Verificar se já existe
-                execucao_existente = db.query(ExecucaoMensal).filter(
-                    and_(
-                        ExecucaoMensal.rubrica_id == rubrica_id,
-                        ExecucaoMensal.mes == mes,
-                        ExecucaoMensal.ano == exercicio
-                    )
-                ).first()
-                
-                # Usar recalculate_execucao_mensal que cria apenas quando há gasto > 0
-                execucao = recalculate_execucao_mensal(db, rubrica_id, mes, exercicio)
-                if execucao:
-                    if not execucao_existente:
-                        criadas += 1
-                    else:
-                        atualizadas += 1
-            except Exception as e:
-                erros.append(f"Rubrica {rubrica_id}, Mês {mes}: {str(e)}")
-                print(f"   ⚠️  Erro: Rubrica {rubrica_id}, Mês {mes}: {e}")
+        # Dotação mensal (dotacao_calculada / 12) das rubricas envolvidas, calculada uma vez
+        # por rubrica
+        rubrica_ids = {rubrica_id for rubrica_id, _, _ in gastos}
+        dotacao_mensal_map = {
+            rubrica_id: (dotacao_calculada or Decimal("0.00")) / Decimal("12.00")
+            for rubrica_id, dotacao_calculada in db.query(
+                Rubrica.id, Rubrica.dotacao_calculada
+            ).filter(Rubrica.id.in_(rubrica_ids)).all()
+        } if rubrica_ids else {}
+        
+        novas = []
+        alteradas = []
+        for rubrica_id, mes, gasto in gastos:
+            gasto = gasto or Decimal("0.00")
+            if rubrica_id not in dotacao_mensal_map:
+                erros.append(f"Rubrica {rubrica_id}, Mês {mes}: Rubrica {rubrica_id} não encontrada")
+                print(f"   ⚠️  Erro: Rubrica {rubrica_id}, Mês {mes}: Rubrica não encontrada")
+                continue
+            
+            existente = existentes.get((rubrica_id, mes))
+            if existente:
+                # Se já existe, manter a dotação e atualizar gasto e saldo
+                execucao_id, dotacao = existente
+                alteradas.append({"id": execucao_id, "gasto": gasto, "saldo": dotacao - gasto})
+            elif gasto > 0:
+                # Só criar se houver gasto; dotação = dotacao_calculada distribuída pelos 12 meses
+                dotacao_mensal = dotacao_mensal_map[rubrica_id]
+                novas.append({
+                    "rubrica_id": rubrica_id,
+                    "mes": mes,
+                    "ano": exercicio,
+                    "dotacao": dotacao_mensal,
+                    "gasto": gasto,
+                    "saldo": dotacao_mensal - gasto
+                })
+        
+        # Gravar em lote: um INSERT e um UPDATE (executemany) em vez de um por combinação
+        db.bulk_insert_mappings(ExecucaoMensal, novas)
+        db.bulk_update_mappings(ExecucaoMensal, alteradas)
+        criadas = len(novas)
+        atualizadas = len(alteradas)
         
         print(f"   ✅ Criadas: {criadas}, Atualizadas: {atualizadas}")
         
         db.commit()
         
-        # Verificar estado depois
-        count_depois = db.query(ExecucaoMensal).filter(
-            ExecucaoMensal.ano == exercicio
-        ).count()
+        # Estado depois: o script só insere, nunca remove
+        count_depois = count_antes + criadas
         
         print(f"\n" + "=" * 60)
         print(f"RESUMO")
@@ -0,0 +1,9 @@
+-- Script para substituir o índice isolado em reconciliation_issue.resolvido
+-- Índices em colunas booleanas têm seletividade baixa e custam escrita;
+-- o índice composto serve a consulta real: problemas pendentes por rubrica.
+
+USE sistema_contabil;
+
+DROP INDEX IF EXISTS ix_reconciliation_issue_resolvido ON reconciliation_issue;
+
+CREATE INDEX idx_recon_unresolved ON reconciliation_issue (rubrica_id, resolvido);
@@ -8,7 +8,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.db import SessionLocal
 from app.models import ExecucaoMensal, Rubrica, Despesa, StatusDespesa
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, tuple_
+from sqlalchemy.orm import joinedload
 
 def verificar_execucao_mensal(exercicio: int = 2025):
     """Verifica registros de execucao_mensal."""
@@ -20,44 +21,61 @@ def verificar_execucao_mensal(exercicio: int = 2025):
         print(f"Verificação Execução Mensal - Exercício {exercicio}")
         print("=" * 60)
         
-        # Contar registros
-        total = db.query(ExecucaoMensal).filter(
+        # Contagem e totais do exercício numa única consulta agregada
+        total, total_dotacao, total_gasto, total_saldo = db.query(
+            func.count(ExecucaoMensal.id),
+            func.sum(ExecucaoMensal.dotacao),
+            func.sum(ExecucaoMensal.gasto),
+            func.sum(ExecucaoMensal.saldo)
+        ).filter(
             ExecucaoMensal.ano == exercicio
-        ).count()
+        ).one()
         print(f"\nTotal de registros: {total}")
         
         # Mostrar alguns exemplos com despesas
         print("\nExemplos de registros com despesas confirmadas:")
         print("-" * 60)
         
-        # Buscar execucao_mensal que têm gasto > 0
-        execucoes_com_gasto = db.query(ExecucaoMensal).filter(
+        # Buscar execucao_mensal que têm gasto > 0 (rubrica carregada no mesmo SELECT)
+        execucoes_com_gasto = db.query(ExecucaoMensal).options(
+            joinedload(ExecucaoMensal.rubrica)
+        ).filter(
             and_(
                 ExecucaoMensal.ano == exercicio,
                 ExecucaoMensal.gasto > 0
             )
         ).limit(5).all()
         
+        # Despesas confirmadas (quantidade e soma) só dos pares (rubrica, mês) mostrados,
+        # numa só consulta agregada
+        despesas_por_chave = {}
+        if execucoes_com_gasto:
+            despesas_por_chave = {
+                (rubrica_id, mes): (quantidade, soma)
+                for rubrica_id, mes, quantidade, soma in db.query(
+                    Despesa.rubrica_id, Despesa.mes, func.count(Despesa.id), func.sum(Despesa.valor)
+                ).filter(
+                    and_(
+                        tuple_(Despesa.rubrica_id, Despesa.mes).in_(
+                            [(e.rubrica_id, e.mes) for e in execucoes_com_gasto]
+                        ),
+                        Despesa.exercicio == exercicio,
+                        Despesa.status == StatusDespesa.CONFIRMADA
+                    )
+                ).group_by(Despesa.rubrica_id, Despesa.mes).all()
+            }
+        
         for exec in execucoes_com_gasto:
-            rubrica = db.query(Rubrica).filter(Rubrica.id == exec.rubrica_id).first()
-            # Verificar despesas confirmadas
-            despesas = db.query(Despesa).filter(
-                and_(
-                    Despesa.rubrica_id == exec.rubrica_id,
-                    Despesa.mes == exec.mes,
-                    Despesa.exercicio == exercicio,
-                    Despesa.status == StatusDespesa.CONFIRMADA
-                )
-            ).all()
+            rubrica = exec.rubrica
+            quantidade, soma_despesas = despesas_por_chave.get((exec.rubrica_id, exec.mes), (0, None))
             
             print(f"\nRubrica: {rubrica.codigo if rubrica else 'N/A'} - {rubrica.designacao[:50] if rubrica else 'N/A'}")
             print(f"  Mês: {exec.mes}/{exec.ano}")
             print(f"  Dotação: {exec.dotacao:,.2f}")
             print(f"  Gasto: {exec.gasto:,.2f}")
             print(f"  Saldo: {exec.saldo:,.2f}")
-            print(f"  Despesas confirmadas: {len(despesas)}")
-            if despesas:
-                soma_despesas = sum(d.valor for d in despesas)
+            print(f"  Despesas confirmadas: {quantidade}")
+            if quantidade:
                 print(f"  Soma das despesas: {soma_despesas:,.2f}")
                 print(f"  ✅ Gasto coincide: {exec.gasto == soma_despesas}")
         
@@ -66,21 +84,9 @@ def verificar_execucao_mensal(exercicio: int = 2025):
         print("Estatísticas Gerais:")
         print("-" * 60)
         
-        total_dotacao = db.query(func.sum(ExecucaoMensal.dotacao)).filter(
-            ExecucaoMensal.ano == exercicio
-        ).scalar() or 0
-        
-        total_gasto = db.query(func.sum(ExecucaoMensal.gasto)).filter(
-            ExecucaoMensal.ano == exercicio
-        ).scalar() or 0
-        
-        total_saldo = db.query(func.sum(ExecucaoMensal.saldo)).filter(
-            ExecucaoMensal.ano == exercicio
-        ).scalar() or 0
-        
-        print(f"Total de Dotação (soma de todos os meses): {total_dotacao:,.2f}")
-        print(f"Total de Gasto: {total_gasto:,.2f}")
-        print(f"Total de Saldo: {total_saldo:,.2f}")
+        print(f"Total de Dotação (soma de todos os meses): {total_dotacao or 0:,.2f}")
+        print(f"Total de Gasto: {total_gasto or 0:,.2f}")
+        print(f"Total de Saldo: {total_saldo or 0:,.2f}")
         
         # Verificar se dotacao_calculada / 12 está sendo usado corretamente
         print("\n" + "=" * 60)
@@ -93,17 +99,22 @@ def verificar_execucao_mensal(exercicio: int = 2025):
             Rubrica.dotacao_calculada > 0
         ).limit(3).all()
         
-        for rubrica in rubricas_com_dotacao:
-            execucoes = db.query(ExecucaoMensal).filter(
+        # Dotação mensal registada por rubrica (todas as linhas do ano usam o mesmo valor),
+        # numa só consulta agregada em vez de carregar todas as execuções de cada rubrica
+        dotacao_real_por_rubrica = dict(
+            db.query(ExecucaoMensal.rubrica_id, func.min(ExecucaoMensal.dotacao)).filter(
                 and_(
-                    ExecucaoMensal.rubrica_id == rubrica.id,
+                    ExecucaoMensal.rubrica_id.in_([r.id for r in rubricas_com_dotacao]),
                     ExecucaoMensal.ano == exercicio
                 )
-            ).all()
+            ).group_by(ExecucaoMensal.rubrica_id).all()
+        ) if rubricas_com_dotacao else {}
+        
+        for rubrica in rubricas_com_dotacao:
+            dotacao_mensal_real = dotacao_real_por_rubrica.get(rubrica.id)
             
-            if execucoes:
+            if dotacao_mensal_real is not None:
                 dotacao_mensal_esperada = rubrica.dotacao_calculada / 12
-                dotacao_mensal_real = execucoes[0].dotacao
                 
                 print(f"\nRubrica: {rubrica.codigo}")
                 print(f"  Dotação Calculada Anual: {rubrica.dotacao_calculada:,.2f}")
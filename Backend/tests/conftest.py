@@ -0,0 +1,112 @@
+"""
+Configuração partilhada pelos testes: engine de teste, esquema, sessão por teste,
+hashes de senha e contador de consultas.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+
+# TEST_DATABASE_URL aponta os testes para um servidor real (MySQL/PostgreSQL).
+# Usar um banco dedicado: as tabelas são criadas e removidas (drop_all) na sessão.
+# Correr sem xdist: o banco é partilhado entre workers.
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+def pytest_configure(config):
+    """
+    Antes da recolha (e portanto antes de qualquer import de app): o app.db cria o
+    engine ao importar; apontá-lo para SQLite em memória evita carregar o driver
+    MySQL. Nenhum teste usa esse engine (usam o fixture engine e substituem
+    get_db); um DATABASE_URL definido explicitamente é respeitado.
+    """
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+
+@pytest.fixture(scope="session")
+def engine():
+    """
+    Engine de teste, um por processo.
+    Banco em memória com uma única ligação partilhada (StaticPool): cada worker
+    do pytest-xdist é um processo próprio, logo tem o seu banco isolado.
+    """
+    if TEST_DATABASE_URL:
+        engine = create_engine(TEST_DATABASE_URL)
+    else:
+        engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool
+        )
+
+        @event.listens_for(engine, "connect")
+        def _sqlite_connect(dbapi_connection, connection_record):
+            # O pysqlite gere BEGIN por conta própria e quebra os SAVEPOINTs: desativar
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _sqlite_begin(conn):
+            conn.exec_driver_sql("BEGIN")
+
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def schema(engine):
+    """
+    Cria o esquema uma vez por processo (o DDL não se repete por teste nem por módulo).
+    Num servidor real o DDL faz commit implícito (não é desfeito pelo rollback),
+    por isso as tabelas são removidas no fim; o banco em memória desaparece
+    sozinho com o engine.
+    """
+    from app.db import Base
+
+    Base.metadata.create_all(bind=engine)
+    yield
+    if TEST_DATABASE_URL:
+        Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture(scope="function")
+def db(engine, schema):
+    """
+    Sessão de teste dentro de uma transação desfeita no fim do teste.
+    Os commits da sessão tornam-se SAVEPOINTs (nenhum DDL por teste).
+    Os fixtures só fazem flush (o id vem do INSERT): a API usa esta mesma sessão.
+    """
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = TestingSessionLocal(bind=connection, join_transaction_mode="create_savepoint")
+    try:
+        yield db
+    finally:
+        db.close()
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture(scope="session")
+def hashed_pws():
+    """Hashes bcrypt calculados uma vez por processo (bcrypt é lento de propósito)."""
+    from app.crud import get_password_hash
+
+    return {p: get_password_hash(p) for p in ("test123", "password", "admin123", "temp123")}
+
+
+@pytest.fixture(scope="function")
+def query_counter(engine):
+    """Regista as instruções SQL executadas no engine de teste (para detetar N+1)."""
+    statements = []
+
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _count)
+    yield statements
+    event.remove(engine, "before_cursor_execute", _count)
@@ -3,28 +3,9 @@ Testes automatizados para autenticação.
 """
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from app.main import app
-from app.db import Base, get_db
+from app.db import get_db
 from app.models import Usuario
-from app.crud import get_password_hash
-
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test_auth.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-
-@pytest.fixture(scope="function")
-def db():
-    """Cria banco de dados de teste."""
-    Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-        Base.metadata.drop_all(bind=engine)
 
 
 @pytest.fixture(scope="function")
@@ -43,17 +24,16 @@ def client(db):
 
 
 @pytest.fixture(scope="function")
-def test_user(db):
+def test_user(db, hashed_pws):
     """Cria usuário de teste."""
     usuario = Usuario(
         username="testuser",
         nome="Test User",
-        senha_hash=get_password_hash("test123"),
+        senha_hash=hashed_pws["test123"],
         activo=True
     )
     db.add(usuario)
-    db.commit()
-    db.refresh(usuario)
+    db.flush()
     return usuario
 
 
@@ -89,12 +69,12 @@ class TestAuth:
         )
         assert response.status_code == 401
     
-    def test_login_inactive_user(self, client, db):
+    def test_login_inactive_user(self, client, db, hashed_pws):
         """Testa login com usuário inativo."""
         usuario = Usuario(
             username="inactive",
             nome="Inactive User",
-            senha_hash=get_password_hash("password"),
+            senha_hash=hashed_pws["password"],
             activo=False
         )
         db.add(usuario)
@@ -111,7 +91,7 @@ class TestAuth:
         response = client.get("/api/v1/despesas")
         assert response.status_code == 401
     
-    def test_protected_endpoint_with_token(self, client, test_user):
+    def test_protected_endpoint_with_token(self, client, test_user, query_counter):
         """Testa acesso a endpoint protegido com token válido."""
         # Login
         login_response = client.post(
@@ -121,9 +101,11 @@ class TestAuth:
         token = login_response.json()["access_token"]
         
         # Acessa endpoint protegido
+        query_counter.clear()
         response = client.get(
             "/api/v1/despesas",
             headers={"Authorization": f"Bearer {token}"}
         )
         assert response.status_code == 200
+        assert len(query_counter) < 10
 
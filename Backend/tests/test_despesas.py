@@ -3,30 +3,17 @@ Testes automatizados para CRUD de Despesas.
 """
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from app.main import app
-from app.db import Base, get_db
-from app.models import Usuario, Rubrica, Fornecedor, Despesa, StatusDespesa, TipoRubrica, StatusRubrica, TipoFornecedor
-from app.crud import create_usuario, create_rubrica, create_fornecedor, get_password_hash
+from app.api.auth import create_access_token
+from app.db import get_db
+from app.models import (
+    Usuario, Rubrica, Fornecedor, Despesa, StatusDespesa, TipoRubrica, StatusRubrica, TipoFornecedor,
+    DotacaoGlobal, DotacaoGlobalMov, ExecucaoMensal
+)
+from app.crud import create_usuario, create_rubrica, create_fornecedor
+from app.services.despesa_service import confirm_despesas_bulk
 from datetime import date, datetime
-
-# Banco de dados de teste em memória
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-
-@pytest.fixture(scope="function")
-def db():
-    """Cria banco de dados de teste para cada teste."""
-    Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-        Base.metadata.drop_all(bind=engine)
+from decimal import Decimal
 
 
 @pytest.fixture(scope="function")
@@ -45,29 +32,26 @@ def client(db):
 
 
 @pytest.fixture(scope="function")
-def admin_user(db):
+def admin_user(db, hashed_pws):
     """Cria usuário admin para testes."""
     usuario = Usuario(
         username="admin_test",
         nome="Admin Test",
-        senha_hash=get_password_hash("admin123"),
+        senha_hash=hashed_pws["admin123"],
         activo=True
     )
     db.add(usuario)
-    db.commit()
-    db.refresh(usuario)
+    db.flush()
     return usuario
 
 
 @pytest.fixture(scope="function")
-def auth_token(client, admin_user):
-    """Obtém token de autenticação."""
-    response = client.post(
-        "/auth/login-json",
-        json={"username": "admin_test", "senha": "admin123"}
-    )
-    assert response.status_code == 200
-    return response.json()["access_token"]
+def auth_token(admin_user):
+    """
+    Obtém token de autenticação.
+    Emitido diretamente (o login e o bcrypt já são testados em test_auth.py).
+    """
+    return create_access_token(data={"sub": admin_user.username})
 
 
 @pytest.fixture(scope="function")
@@ -83,23 +67,21 @@ def rubrica(db, admin_user):
         status=StatusRubrica.ATIVA
     )
     db.add(rubrica)
-    db.commit()
-    db.refresh(rubrica)
+    db.flush()
     return rubrica
 
 
 @pytest.fixture(scope="function")
-def fornecedor(db, admin_user):
+def fornecedor(db, admin_user, hashed_pws):
     """Cria fornecedor para testes."""
     usuario = Usuario(
         username="fornecedor_test",
         nome="Fornecedor Test",
-        senha_hash=get_password_hash("temp123"),
+        senha_hash=hashed_pws["temp123"],
         activo=True
     )
     db.add(usuario)
-    db.commit()
-    db.refresh(usuario)
+    db.flush()
     
     fornecedor = Fornecedor(
         usuario_id=usuario.id,
@@ -107,11 +89,44 @@ def fornecedor(db, admin_user):
         activo=True
     )
     db.add(fornecedor)
-    db.commit()
-    db.refresh(fornecedor)
+    db.flush()
     return fornecedor
 
 
+@pytest.fixture(scope="function")
+def dotacao_global(db):
+    """Cria dotação global de 2024 com 10000.00 de saldo."""
+    dotacao = DotacaoGlobal(
+        exercicio=2024,
+        valor_anual=Decimal("10000.00"),
+        saldo=Decimal("10000.00"),
+        reservado=Decimal("0.00")
+    )
+    db.add(dotacao)
+    db.flush()
+    return dotacao
+
+
+@pytest.fixture(scope="function")
+def despesas_pendentes(db, rubrica, fornecedor):
+    """Cria duas despesas pendentes (5000.00 e 3000.00) na rubrica de teste."""
+    despesas = [
+        Despesa(
+            rubrica_id=rubrica.id,
+            fornecedor_id=fornecedor.id,
+            valor=Decimal(valor),
+            data_emissao=date(2024, 3, 15),
+            exercicio=2024,
+            mes=3,
+            status=StatusDespesa.PENDENTE
+        )
+        for valor in ("5000.00", "3000.00")
+    ]
+    db.add_all(despesas)
+    db.flush()
+    return despesas
+
+
 class TestDespesaCRUD:
     """Testes de CRUD de despesas."""
     
@@ -179,8 +194,7 @@ class TestDespesaCRUD:
             status=StatusDespesa.PENDENTE
         )
         db.add(despesa)
-        db.commit()
-        db.refresh(despesa)
+        db.flush()
         
         # Atualiza
         response = client.put(
@@ -207,8 +221,7 @@ class TestDespesaCRUD:
             status=StatusDespesa.CONFIRMADA
         )
         db.add(despesa)
-        db.commit()
-        db.refresh(despesa)
+        db.flush()
         
         # Tenta atualizar (deve falhar para não-admin)
         response = client.put(
@@ -234,8 +247,7 @@ class TestDespesaCRUD:
             status=StatusDespesa.PENDENTE
         )
         db.add(despesa)
-        db.commit()
-        db.refresh(despesa)
+        db.flush()
         
         # Confirma
         response = client.post(
@@ -259,8 +271,7 @@ class TestDespesaCRUD:
             status=StatusDespesa.PENDENTE
         )
         db.add(despesa)
-        db.commit()
-        db.refresh(despesa)
+        db.flush()
         
         # Cancela
         response = client.delete(
@@ -278,7 +289,7 @@ class TestDespesaCRUD:
         data = response.json()
         assert data["status"] == "cancelada"
     
-    def test_list_despesas_with_filters(self, client, auth_token, rubrica, fornecedor, db):
+    def test_list_despesas_with_filters(self, client, auth_token, rubrica, fornecedor, db, query_counter, hashed_pws):
         """Testa listagem de despesas com filtros."""
         # Cria despesas
         for i in range(3):
@@ -294,17 +305,63 @@ class TestDespesaCRUD:
             db.add(despesa)
         db.commit()
         
-        # Lista todas
-        response = client.get(
-            "/api/v1/despesas",
-            headers={"Authorization": f"Bearer {auth_token}"}
-        )
-        assert response.status_code == 200
-        assert len(response.json()) >= 3
+        # Lista todas (sem N+1: número de consultas não cresce com as despesas)
+        def _listar():
+            query_counter.clear()
+            response = client.get(
+                "/api/v1/despesas?limit=50",
+                headers={"Authorization": f"Bearer {auth_token}"}
+            )
+            assert response.status_code == 200
+            return len(response.json()), len(query_counter)
+        
+        total, consultas_3 = _listar()
+        assert total == 3
+        
+        # Cada nova despesa com rubrica e fornecedor próprios: um carregamento
+        # por linha (N+1) faria crescer o número de consultas
+        for i in range(17):
+            usuario = Usuario(
+                username=f"fornecedor_{i}",
+                nome=f"Fornecedor {i}",
+                senha_hash=hashed_pws["temp123"],
+                activo=True
+            )
+            outra_rubrica = Rubrica(
+                codigo=f"47/H000/9.{i}",
+                designacao=f"Rubrica {i}",
+                tipo=TipoRubrica.DESPESA,
+                nivel=1,
+                exercicio=2024,
+                status=StatusRubrica.ATIVA
+            )
+            db.add_all([usuario, outra_rubrica])
+            db.flush()
+            outro_fornecedor = Fornecedor(
+                usuario_id=usuario.id,
+                tipo=TipoFornecedor.PESSOA_COLETIVA,
+                activo=True
+            )
+            db.add(outro_fornecedor)
+            db.flush()
+            db.add(Despesa(
+                rubrica_id=outra_rubrica.id,
+                fornecedor_id=outro_fornecedor.id,
+                valor=100.00 * (i + 1),
+                data_emissao=date(2024, 3, 1 + i),
+                exercicio=2024,
+                mes=3,
+                status=StatusDespesa.PENDENTE
+            ))
+        db.commit()
+        
+        total, consultas_20 = _listar()
+        assert total == 20
+        assert consultas_20 == consultas_3
         
         # Filtra por status
         response = client.get(
-            "/api/v1/despesas?status=pendente",
+            "/api/v1/despesas?status=pendente&limit=10",
             headers={"Authorization": f"Bearer {auth_token}"}
         )
         assert response.status_code == 200
@@ -313,10 +370,165 @@ class TestDespesaCRUD:
         
         # Filtra por rubrica
         response = client.get(
-            f"/api/v1/despesas?rubrica_id={rubrica.id}",
+            f"/api/v1/despesas?rubrica_id={rubrica.id}&limit=10",
             headers={"Authorization": f"Bearer {auth_token}"}
         )
         assert response.status_code == 200
         data = response.json()
         assert all(d["rubrica_id"] == rubrica.id for d in data)
 
+
+class TestConfirmBatch:
+    """Testes da confirmação em lote (/confirm-batch) com dotação global."""
+    
+    def _movimentos(self, db, dotacao):
+        return db.query(DotacaoGlobalMov).filter(
+            DotacaoGlobalMov.dotacao_global_id == dotacao.id
+        ).all()
+    
+    def test_confirm_batch(self, client, auth_token, db, dotacao_global, despesas_pendentes):
+        """Testa que o lote debita o saldo e regista um movimento por despesa."""
+        ids = [d.id for d in despesas_pendentes]
+        response = client.post(
+            "/api/v1/despesas/confirm-batch",
+            headers={"Authorization": f"Bearer {auth_token}"},
+            json={"despesa_ids": ids}
+        )
+        assert response.status_code == 200
+        assert response.json()["confirmadas"] == ids
+        
+        db.expire_all()
+        assert dotacao_global.saldo == Decimal("2000.00")
+        movimentos = self._movimentos(db, dotacao_global)
+        assert sorted(m.referencia for m in movimentos) == sorted(str(i) for i in ids)
+        assert sorted(m.valor for m in movimentos) == [Decimal("-5000.00"), Decimal("-3000.00")]
+        assert all(d.status == StatusDespesa.CONFIRMADA for d in despesas_pendentes)
+    
+    def test_confirm_batch_ids_repetidos(self, client, auth_token, db, dotacao_global, despesas_pendentes):
+        """Testa que ids repetidos no pedido são confirmados e debitados uma só vez."""
+        d1, d2 = despesas_pendentes
+        response = client.post(
+            "/api/v1/despesas/confirm-batch",
+            headers={"Authorization": f"Bearer {auth_token}"},
+            json={"despesa_ids": [d1.id, d1.id, d2.id, d1.id]}
+        )
+        assert response.status_code == 200
+        assert response.json()["confirmadas"] == [d1.id, d2.id]
+        
+        db.expire_all()
+        assert dotacao_global.saldo == Decimal("2000.00")
+        assert len(self._movimentos(db, dotacao_global)) == 2
+    
+    def test_confirm_batch_id_inexistente(self, client, auth_token, db, dotacao_global, despesas_pendentes):
+        """Testa que um id inexistente devolve 404 sem confirmar nenhuma despesa."""
+        db.commit()  # Os dados do teste sobrevivem ao rollback da API
+        response = client.post(
+            "/api/v1/despesas/confirm-batch",
+            headers={"Authorization": f"Bearer {auth_token}"},
+            json={"despesa_ids": [despesas_pendentes[0].id, 999999]}
+        )
+        assert response.status_code == 404
+        assert "999999" in response.json()["detail"]
+        
+        db.expire_all()
+        assert dotacao_global.saldo == Decimal("10000.00")
+        assert self._movimentos(db, dotacao_global) == []
+        assert all(d.status == StatusDespesa.PENDENTE for d in despesas_pendentes)
+    
+    def test_confirm_batch_saldo_insuficiente(self, client, auth_token, db, dotacao_global, despesas_pendentes):
+        """Testa que um lote acima do saldo devolve 400 e não grava nada."""
+        dotacao_global.saldo = Decimal("7000.00")
+        db.commit()  # Os dados do teste sobrevivem ao rollback da API
+        response = client.post(
+            "/api/v1/despesas/confirm-batch",
+            headers={"Authorization": f"Bearer {auth_token}"},
+            json={"despesa_ids": [d.id for d in despesas_pendentes]}
+        )
+        assert response.status_code == 400
+        assert "saldo insuficiente" in response.json()["detail"].lower()
+        
+        db.expire_all()
+        assert dotacao_global.saldo == Decimal("7000.00")
+        assert self._movimentos(db, dotacao_global) == []
+        assert all(d.status == StatusDespesa.PENDENTE for d in despesas_pendentes)
+    
+    def test_confirm_batch_override_nao_admin(self, client, auth_token, db, dotacao_global, despesas_pendentes):
+        """Testa que override por um usuário sem papel admin devolve 403."""
+        dotacao_global.saldo = Decimal("1000.00")
+        db.commit()  # Os dados do teste sobrevivem ao rollback da API
+        response = client.post(
+            "/api/v1/despesas/confirm-batch",
+            headers={"Authorization": f"Bearer {auth_token}"},
+            json={"despesa_ids": [d.id for d in despesas_pendentes], "override": True}
+        )
+        assert response.status_code == 403
+        
+        db.expire_all()
+        assert dotacao_global.saldo == Decimal("1000.00")
+        assert self._movimentos(db, dotacao_global) == []
+        assert all(d.status == StatusDespesa.PENDENTE for d in despesas_pendentes)
+
+
+@pytest.fixture(scope="function")
+def arvore_rubricas(db):
+    """
+    Cria a árvore raiz -> filho -> folha, mais uma segunda folha sob a raiz.
+    Devolve um dicionário nome -> rubrica.
+    """
+    def _rubrica(codigo, parent=None):
+        rubrica = Rubrica(
+            codigo=codigo,
+            designacao=f"Rubrica {codigo}",
+            tipo=TipoRubrica.DESPESA,
+            parent_id=parent.id if parent else None,
+            nivel=(parent.nivel + 1) if parent else 1,
+            exercicio=2024,
+            status=StatusRubrica.ATIVA
+        )
+        db.add(rubrica)
+        db.flush()
+        return rubrica
+    
+    raiz = _rubrica("9")
+    filho = _rubrica("9.1", raiz)
+    folha = _rubrica("9.1.1", filho)
+    outra = _rubrica("9.2", raiz)
+    return {"raiz": raiz, "filho": filho, "folha": folha, "outra": outra}
+
+
+class TestConfirmDespesasBulk:
+    """Testes da execução mensal gravada por confirm_despesas_bulk."""
+    
+    def test_execucao_mensal_folha_e_ancestrais(self, db, arvore_rubricas):
+        """
+        Testa o gasto por (rubrica, mês) na folha e em todos os ancestrais,
+        e que meses sem gasto não criam linha.
+        """
+        r = arvore_rubricas
+        despesas = [
+            Despesa(rubrica_id=rubrica.id, valor=Decimal(valor), exercicio=2024,
+                    mes=mes, status=StatusDespesa.PENDENTE)
+            for rubrica, valor, mes in (
+                (r["folha"], "1000.00", 3),
+                (r["folha"], "500.00", 3),
+                (r["outra"], "200.00", 4),
+            )
+        ]
+        db.add_all(despesas)
+        db.flush()
+        
+        confirm_despesas_bulk(db, [d.id for d in despesas])
+        
+        gasto = {
+            (e.rubrica_id, e.mes): e.gasto
+            for e in db.query(ExecucaoMensal).filter(ExecucaoMensal.ano == 2024).all()
+        }
+        # folha(4), filho(4) e outra(3) não têm gasto: nenhuma linha criada
+        assert gasto == {
+            (r["folha"].id, 3): Decimal("1500.00"),
+            (r["filho"].id, 3): Decimal("1500.00"),
+            (r["raiz"].id, 3): Decimal("1500.00"),
+            (r["outra"].id, 4): Decimal("200.00"),
+            (r["raiz"].id, 4): Decimal("200.00"),
+        }
+        assert all(d.status == StatusDespesa.CONFIRMADA for d in despesas)
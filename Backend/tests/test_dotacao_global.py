@@ -2,28 +2,67 @@
 Testes para Dotação Global Orçamental.
 Inclui testes de concorrência para validar integridade transacional.
 """
+import os
 import pytest
 from decimal import Decimal
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
 from app.models import (
     DotacaoGlobal, DotacaoGlobalMov, TipoDotacaoGlobalMov,
     Despesa, StatusDespesa, Rubrica, TipoRubrica, StatusRubrica
 )
-from app.db import Base, engine, get_db
 from app.crud import create_rubrica
 from app.schemas import RubricaCreate
 
 
+# Todo o módulo num só worker do xdist (--dist=loadgroup): a ligação e rubrica_teste
+# (fixtures de módulo) são criadas uma vez em vez de uma por worker
+pytestmark = pytest.mark.xdist_group("dotacao_global")
+
+# O engine, o esquema e TEST_DATABASE_URL vêm do conftest.py; com um servidor
+# real, test_for_update_bloqueia_segunda_ligacao valida o bloqueio com duas ligações.
+_TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture(scope="module")
+def _connection(engine, schema):
+    """
+    Abre a transação externa do módulo, desfeita no fim: os dados partilhados
+    pelo módulo (rubrica_teste) vivem nela.
+    """
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
 @pytest.fixture
-def db_session():
-    """Cria uma sessão de teste."""
-    Base.metadata.create_all(bind=engine)
-    session = Session(bind=engine)
+def db_session(_connection):
+    """
+    Cria uma sessão de teste dentro de um SAVEPOINT desfeito no fim do teste.
+    Os commits e os blocos begin_nested() da sessão tornam-se SAVEPOINTs: nenhum
+    commit real (nem fsync) chega ao banco durante os testes.
+    Sem expirar no commit: o estado em memória já é o que o teste gravou, as
+    asserções leem-no sem novo SELECT.
+    Sem autoflush (como o TestingSessionLocal do conftest.py): as consultas
+    não voltam a fazer flush; a saída de cada begin_nested() e o commit já o fazem.
+    """
+    savepoint = _connection.begin_nested()
+    session = Session(
+        bind=_connection,
+        join_transaction_mode="create_savepoint",
+        expire_on_commit=False,
+        autoflush=False
+    )
     try:
         yield session
     finally:
-        session.rollback()
         session.close()
+        savepoint.rollback()
 
 
 @pytest.fixture
@@ -36,14 +75,16 @@ def dotacao_global_2024(db_session: Session):
         reservado=Decimal("0.00")
     )
     db_session.add(dotacao)
-    db_session.commit()
-    db_session.refresh(dotacao)
+    db_session.flush()
     return dotacao
 
 
-@pytest.fixture
-def rubrica_teste(db_session: Session):
-    """Cria uma rubrica de teste."""
+@pytest.fixture(scope="module")
+def rubrica_teste(_connection):
+    """
+    Cria uma rubrica de teste, uma vez por módulo (nenhum teste a altera).
+    Fica na transação externa, fora dos SAVEPOINTs desfeitos por teste.
+    """
     rubrica_data = RubricaCreate(
         codigo="1.1.1",
         designacao="Rubrica Teste",
@@ -53,7 +94,8 @@ def rubrica_teste(db_session: Session):
         exercicio=2024,
         status=StatusRubrica.ATIVA
     )
-    return create_rubrica(db_session, rubrica_data)
+    with Session(bind=_connection, join_transaction_mode="create_savepoint") as session:
+        return create_rubrica(session, rubrica_data)
 
 
 class TestDotacaoGlobal:
@@ -85,7 +127,6 @@ class TestDotacaoGlobal:
         dotacao_global_2024.saldo = dotacao_global_2024.saldo + delta
         
         db_session.commit()
-        db_session.refresh(dotacao_global_2024)
         
         assert dotacao_global_2024.valor_anual == novo_valor
         assert dotacao_global_2024.saldo == Decimal("1500000.00")
@@ -99,7 +140,7 @@ class TestDotacaoGlobal:
             descricao="Ajuste de teste"
         )
         db_session.add(movimento)
-        db_session.commit()
+        db_session.flush()
         
         assert movimento.id is not None
         assert movimento.tipo == TipoDotacaoGlobalMov.AJUSTE
@@ -121,17 +162,16 @@ class TestConfirmacaoDespesa:
             status=StatusDespesa.PENDENTE
         )
         db_session.add(despesa)
-        db_session.commit()
-        db_session.refresh(despesa)
+        db_session.flush()
         
         saldo_inicial = dotacao_global_2024.saldo
         
         # Confirma despesa (simula lógica transacional)
-        with db_session.begin():
-            # Lock dotação
+        with db_session.begin_nested():
+            # Lê dotação (o bloqueio FOR UPDATE é validado em TestConcorrencia)
             dotacao = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
-            ).with_for_update().first()
+            ).first()
             
             # Valida saldo
             assert despesa.valor <= dotacao.saldo
@@ -140,19 +180,20 @@ class TestConfirmacaoDespesa:
             dotacao.saldo = dotacao.saldo - despesa.valor
             
             # Registra movimento
-            movimento = DotacaoGlobalMov(
+            db_session.execute(insert(DotacaoGlobalMov).values(
                 dotacao_global_id=dotacao.id,
                 tipo=TipoDotacaoGlobalMov.DESPESA_CONFIRMADA,
                 referencia=str(despesa.id),
                 valor=-despesa.valor,
                 descricao=f"Despesa #{despesa.id} confirmada"
-            )
-            db_session.add(movimento)
+            ))
             
             # Atualiza despesa
             despesa.status = StatusDespesa.CONFIRMADA
         
-        db_session.refresh(dotacao_global_2024)
+        db_session.commit()
+        # Relê só o saldo gravado (SELECT de uma coluna em vez da linha inteira)
+        db_session.expire(dotacao_global_2024, ["saldo"])
         
         assert dotacao_global_2024.saldo == saldo_inicial - despesa.valor
         assert despesa.status == StatusDespesa.CONFIRMADA
@@ -170,21 +211,16 @@ class TestConfirmacaoDespesa:
             status=StatusDespesa.PENDENTE
         )
         db_session.add(despesa)
-        db_session.commit()
-        db_session.refresh(despesa)
+        db_session.flush()
         
         # Tenta confirmar (deve falhar)
-        with db_session.begin():
+        with db_session.begin_nested():
             dotacao = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
-            ).with_for_update().first()
+            ).first()
             
-            # Validação deve falhar
+            # Validação deve falhar: não deve prosseguir
             assert despesa.valor > dotacao.saldo
-            
-            # Não deve prosseguir
-            with pytest.raises(AssertionError):
-                assert despesa.valor <= dotacao.saldo
 
 
 class TestConcorrencia:
@@ -212,16 +248,16 @@ class TestConcorrencia:
             mes=1,
             status=StatusDespesa.PENDENTE
         )
+        # Um único INSERT em lote; os ids vêm do próprio INSERT (sem refresh)
         db_session.add_all([despesa1, despesa2])
-        db_session.commit()
-        db_session.refresh(despesa1)
-        db_session.refresh(despesa2)
+        db_session.flush()
         
         saldo_inicial = dotacao_global_2024.saldo
         
-        # Simula duas transações sequenciais (em produção seriam paralelas)
+        # Simula duas transações sequenciais (em produção seriam paralelas):
+        # cada uma num SAVEPOINT, com um único commit no fim
         # Transação 1
-        with db_session.begin():
+        with db_session.begin_nested():
             dotacao1 = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
             ).with_for_update().first()
@@ -229,18 +265,17 @@ class TestConcorrencia:
             assert despesa1.valor <= dotacao1.saldo
             dotacao1.saldo = dotacao1.saldo - despesa1.valor
             
-            movimento1 = DotacaoGlobalMov(
+            db_session.execute(insert(DotacaoGlobalMov).values(
                 dotacao_global_id=dotacao1.id,
                 tipo=TipoDotacaoGlobalMov.DESPESA_CONFIRMADA,
                 referencia=str(despesa1.id),
                 valor=-despesa1.valor,
                 descricao=f"Despesa #{despesa1.id}"
-            )
-            db_session.add(movimento1)
+            ))
             despesa1.status = StatusDespesa.CONFIRMADA
         
-        # Transação 2 (após commit da primeira)
-        with db_session.begin():
+        # Transação 2 (após a libertação do SAVEPOINT da primeira)
+        with db_session.begin_nested():
             dotacao2 = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
             ).with_for_update().first()
@@ -252,17 +287,18 @@ class TestConcorrencia:
             
             dotacao2.saldo = dotacao2.saldo - despesa2.valor
             
-            movimento2 = DotacaoGlobalMov(
+            db_session.execute(insert(DotacaoGlobalMov).values(
                 dotacao_global_id=dotacao2.id,
                 tipo=TipoDotacaoGlobalMov.DESPESA_CONFIRMADA,
                 referencia=str(despesa2.id),
                 valor=-despesa2.valor,
                 descricao=f"Despesa #{despesa2.id}"
-            )
-            db_session.add(movimento2)
+            ))
             despesa2.status = StatusDespesa.CONFIRMADA
         
-        db_session.refresh(dotacao_global_2024)
+        db_session.commit()
+        # Relê só o saldo gravado (SELECT de uma coluna em vez da linha inteira)
+        db_session.expire(dotacao_global_2024, ["saldo"])
         
         # Valida saldo final
         saldo_esperado = saldo_inicial - despesa1.valor - despesa2.valor
@@ -271,6 +307,51 @@ class TestConcorrencia:
         assert despesa2.status == StatusDespesa.CONFIRMADA
 
 
+    @pytest.mark.skipif(
+        not _TEST_DATABASE_URL,
+        reason="bloqueio real requer servidor (TEST_DATABASE_URL); SQLite ignora FOR UPDATE"
+    )
+    def test_for_update_bloqueia_segunda_ligacao(self, engine, schema):
+        """
+        Duas ligações reais: enquanto a primeira tem a dotação bloqueada (FOR UPDATE),
+        a segunda não a consegue bloquear; após o commit, vê o saldo já reduzido.
+        """
+        tabela = DotacaoGlobal.__table__
+        # Commit real: a linha tem de ser visível para a outra ligação (removida no fim)
+        with engine.begin() as conn:
+            dotacao_id = conn.execute(insert(tabela).values(
+                exercicio=2099,
+                valor_anual=Decimal("1000000.00"),
+                saldo=Decimal("1000000.00"),
+                reservado=Decimal("0.00")
+            )).inserted_primary_key[0]
+        consulta = select(tabela.c.saldo).where(tabela.c.id == dotacao_id)
+        
+        try:
+            with engine.connect() as conn1, engine.connect() as conn2:
+                trans1 = conn1.begin()
+                saldo = conn1.execute(consulta.with_for_update()).scalar()
+                
+                # Transação 2: a linha está bloqueada pela transação 1
+                with pytest.raises(DBAPIError):
+                    with conn2.begin():
+                        conn2.execute(consulta.with_for_update(nowait=True))
+                
+                conn1.execute(
+                    update(tabela).where(tabela.c.id == dotacao_id)
+                    .values(saldo=saldo - Decimal("300000.00"))
+                )
+                trans1.commit()
+                
+                # Após o commit da transação 1, a 2 bloqueia e vê o saldo reduzido
+                with conn2.begin():
+                    saldo_2 = conn2.execute(consulta.with_for_update(nowait=True)).scalar()
+                assert saldo_2 == Decimal("700000.00")
+        finally:
+            with engine.begin() as conn:
+                conn.execute(delete(tabela).where(tabela.c.id == dotacao_id))
+
+
 class TestReservas:
     """Testes de reservas."""
     
@@ -281,10 +362,10 @@ class TestReservas:
         valor_reserva = Decimal("100000.00")
         saldo_inicial = dotacao_global_2024.saldo
         
-        with db_session.begin():
+        with db_session.begin_nested():
             dotacao = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
-            ).with_for_update().first()
+            ).first()
             
             # Valida saldo disponível
             saldo_disponivel = dotacao.saldo - dotacao.reservado
@@ -294,15 +375,14 @@ class TestReservas:
             dotacao.reservado = dotacao.reservado + valor_reserva
             
             # Registra movimento
-            movimento = DotacaoGlobalMov(
+            db_session.execute(insert(DotacaoGlobalMov).values(
                 dotacao_global_id=dotacao.id,
                 tipo=TipoDotacaoGlobalMov.RESERVA,
                 valor=-valor_reserva,
                 descricao="Reserva de teste"
-            )
-            db_session.add(movimento)
+            ))
         
-        db_session.refresh(dotacao_global_2024)
+        db_session.commit()
         
         assert dotacao_global_2024.reservado == valor_reserva
         assert dotacao_global_2024.saldo == saldo_inicial  # Saldo não muda, apenas reservado
@@ -314,34 +394,33 @@ class TestReservas:
         # Primeiro cria uma reserva
         valor_reserva = Decimal("50000.00")
         
-        with db_session.begin():
+        with db_session.begin_nested():
             dotacao = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
-            ).with_for_update().first()
+            ).first()
             dotacao.reservado = dotacao.reservado + valor_reserva
-        db_session.refresh(dotacao_global_2024)
+        db_session.commit()
         
         reservado_inicial = dotacao_global_2024.reservado
         
         # Cancela reserva
-        with db_session.begin():
+        with db_session.begin_nested():
             dotacao = db_session.query(DotacaoGlobal).filter(
                 DotacaoGlobal.id == dotacao_global_2024.id
-            ).with_for_update().first()
+            ).first()
             
             assert valor_reserva <= dotacao.reservado
             
             dotacao.reservado = dotacao.reservado - valor_reserva
             
-            movimento = DotacaoGlobalMov(
+            db_session.execute(insert(DotacaoGlobalMov).values(
                 dotacao_global_id=dotacao.id,
                 tipo=TipoDotacaoGlobalMov.RESERVA_CANCELADA,
                 valor=valor_reserva,
                 descricao="Cancelamento de reserva"
-            )
-            db_session.add(movimento)
+            ))
         
-        db_session.refresh(dotacao_global_2024)
+        db_session.commit()
         
         assert dotacao_global_2024.reservado == reservado_inicial - valor_reserva
 
@@ -4,15 +4,22 @@ Testes para o serviço de importação (dry-run).
 import pytest
 from decimal import Decimal
 from datetime import datetime
+from unittest.mock import Mock
 from app.services.importer import ImportProcessor, FornecedorMatcher, RubricaMatcher
 from app.schemas import ColumnMapping
 from sqlalchemy.orm import Session
 
 
-@pytest.fixture
-def mock_db_session(mocker):
-    """Mock de sessão do banco."""
-    return mocker.Mock(spec=Session)
+@pytest.fixture(scope="module")
+def mock_db_session():
+    """Mock de sessão do banco (o spec de Session é montado uma vez por módulo)."""
+    return Mock(spec=Session)
+
+
+@pytest.fixture(scope="module")
+def import_processor(mock_db_session):
+    """Processador partilhado pelo módulo (process_row não guarda estado por linha)."""
+    return ImportProcessor(mock_db_session, user_id=1, exercicio=2024)
 
 
 @pytest.fixture
@@ -53,10 +60,8 @@ class TestRubricaMatcher:
 class TestImportProcessor:
     """Testes para processador de importação."""
     
-    def test_process_row_valid(self, mock_db_session, sample_mapping):
+    def test_process_row_valid(self, import_processor, sample_mapping):
         """Testa processamento de linha válida."""
-        processor = ImportProcessor(mock_db_session, user_id=1, exercicio=2024)
-        
         row = {
             "codigo": "1.1.1",
             "fornecedor": "Fornecedor Teste",
@@ -67,38 +72,34 @@ class TestImportProcessor:
             "requisicao": "REQ001"
         }
         
-        resultado = processor.process_row(row, sample_mapping, linha_numero=1)
+        resultado = import_processor.process_row(row, sample_mapping, linha_numero=1)
         
         assert resultado["despesa_data"] is not None
         assert resultado["despesa_data"]["valor"] == Decimal("1234.56")
         assert len(resultado["erros"]) == 0
     
-    def test_process_row_missing_required(self, mock_db_session, sample_mapping):
+    def test_process_row_missing_required(self, import_processor, sample_mapping):
         """Testa processamento de linha com campos obrigatórios faltando."""
-        processor = ImportProcessor(mock_db_session, user_id=1, exercicio=2024)
-        
         row = {
             "codigo": "",
             "fornecedor": "",
             "valor": "abc"
         }
         
-        resultado = processor.process_row(row, sample_mapping, linha_numero=1)
+        resultado = import_processor.process_row(row, sample_mapping, linha_numero=1)
         
         assert len(resultado["erros"]) > 0
         assert resultado["despesa_data"] is None
     
-    def test_process_row_invalid_value(self, mock_db_session, sample_mapping):
+    def test_process_row_invalid_value(self, import_processor, sample_mapping):
         """Testa processamento com valor inválido."""
-        processor = ImportProcessor(mock_db_session, user_id=1, exercicio=2024)
-        
         row = {
             "codigo": "1.1.1",
             "fornecedor": "Fornecedor",
             "valor": "invalid"
         }
         
-        resultado = processor.process_row(row, sample_mapping, linha_numero=1)
+        resultado = import_processor.process_row(row, sample_mapping, linha_numero=1)
         
         assert len(resultado["erros"]) > 0
 
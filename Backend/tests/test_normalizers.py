@@ -1,103 +1,141 @@
 """
 Testes para funções de normalização.
 """
+import re
 import pytest
 from decimal import Decimal
+from app.services import importer
 from app.services.importer import normalize_name, normalize_code, parse_currency, parse_date
+from app.services.user_service import _make_temp_email, is_valid_email
 from datetime import datetime
 
 
 class TestNormalizeName:
     """Testes para normalize_name."""
     
-    def test_basic_normalization(self):
-        assert normalize_name("João Silva") == "JOAO SILVA"
-        assert normalize_name("  Maria  Santos  ") == "MARIA SANTOS"
-    
-    def test_remove_accents(self):
-        assert normalize_name("José") == "JOSE"
-        assert normalize_name("São Paulo") == "SAO PAULO"
-        assert normalize_name("Açúcar") == "ACUCAR"
-    
-    def test_compact_spaces(self):
-        assert normalize_name("João    Silva") == "JOAO SILVA"
-        assert normalize_name("  Teste   com   espaços  ") == "TESTE COM ESPACOS"
-    
-    def test_empty_string(self):
-        assert normalize_name("") == ""
-        assert normalize_name("   ") == ""
-    
-    def test_none(self):
-        assert normalize_name(None) == ""
+    @pytest.mark.parametrize("valor,esperado", [
+        # Normalização básica
+        ("João Silva", "JOAO SILVA"),
+        ("  Maria  Santos  ", "MARIA SANTOS"),
+        # Remove acentos
+        ("José", "JOSE"),
+        ("São Paulo", "SAO PAULO"),
+        ("Açúcar", "ACUCAR"),
+        # Compacta espaços
+        ("João    Silva", "JOAO SILVA"),
+        ("  Teste   com   espaços  ", "TESTE COM ESPACOS"),
+        # Vazio / None
+        ("", ""),
+        ("   ", ""),
+        (None, ""),
+    ])
+    def test_normalize_name(self, valor, esperado):
+        assert normalize_name(valor) == esperado
 
 
 class TestNormalizeCode:
     """Testes para normalize_code."""
     
-    def test_basic_normalization(self):
-        assert normalize_code("ABC123") == "ABC123"
-        assert normalize_code("  xyz  ") == "XYZ"
-    
-    def test_uppercase(self):
-        assert normalize_code("abc") == "ABC"
-        assert normalize_code("Test123") == "TEST123"
-    
-    def test_empty_string(self):
-        assert normalize_code("") == ""
-        assert normalize_code("   ") == ""
-    
-    def test_none(self):
-        assert normalize_code(None) == ""
+    @pytest.mark.parametrize("valor,esperado", [
+        ("ABC123", "ABC123"),
+        ("  xyz  ", "XYZ"),
+        # Maiúsculas
+        ("abc", "ABC"),
+        ("Test123", "TEST123"),
+        # Vazio / None
+        ("", ""),
+        ("   ", ""),
+        (None, ""),
+    ])
+    def test_normalize_code(self, valor, esperado):
+        assert normalize_code(valor) == esperado
 
 
 class TestParseCurrency:
     """Testes para parse_currency."""
     
-    def test_pt_format(self):
-        assert parse_currency("1.234.567,89") == Decimal("1234567.89")
-        assert parse_currency("123,45") == Decimal("123.45")
-        assert parse_currency("0,50") == Decimal("0.50")
-    
-    def test_en_format(self):
-        assert parse_currency("1,234,567.89") == Decimal("1234567.89")
-        assert parse_currency("123.45") == Decimal("123.45")
-    
-    def test_simple_format(self):
-        assert parse_currency("1234.56") == Decimal("1234.56")
-        assert parse_currency("1234,56") == Decimal("1234.56")
-    
-    def test_with_currency_symbol(self):
-        assert parse_currency("€1.234,56") == Decimal("1234.56")
-        assert parse_currency("$1,234.56") == Decimal("1234.56")
-        assert parse_currency("1.234,56 €") == Decimal("1234.56")
-    
-    def test_with_spaces(self):
-        assert parse_currency("1 234,56") == Decimal("1234.56")
-        assert parse_currency("  1234.56  ") == Decimal("1234.56")
-    
-    def test_invalid(self):
-        assert parse_currency("abc") is None
-        assert parse_currency("") is None
-        assert parse_currency("   ") is None
-        assert parse_currency(None) is None
+    @pytest.mark.parametrize("valor,esperado", [
+        # Formato PT
+        ("1.234.567,89", Decimal("1234567.89")),
+        ("123,45", Decimal("123.45")),
+        ("0,50", Decimal("0.50")),
+        # Formato EN
+        ("1,234,567.89", Decimal("1234567.89")),
+        ("123.45", Decimal("123.45")),
+        # Formato simples
+        ("1234.56", Decimal("1234.56")),
+        ("1234,56", Decimal("1234.56")),
+        # Com símbolo de moeda
+        ("€1.234,56", Decimal("1234.56")),
+        ("$1,234.56", Decimal("1234.56")),
+        ("1.234,56 €", Decimal("1234.56")),
+        # Com espaços
+        ("1 234,56", Decimal("1234.56")),
+        ("  1234.56  ", Decimal("1234.56")),
+        # Metical (MT / MZN)
+        ("MT 1.234,56", Decimal("1234.56")),
+        ("1.234,56 MZN", Decimal("1234.56")),
+        # Apenas separadores de milhares
+        ("1.234.567", Decimal("1234567")),
+        # Negativos: sinal (mesmo separado por espaço ou após o símbolo) e parênteses
+        ("- 50", Decimal("-50")),
+        ("€ -50,00", Decimal("-50.00")),
+        ("(1.234,56)", Decimal("-1234.56")),
+        ("(-50)", None),
+        # Inválidos (texto com dígitos não é um valor)
+        ("abc", None),
+        ("abc123", None),
+        ("REQ001", None),
+        ("Ref 2024", None),
+        ("12abc", None),
+        ("", None),
+        ("   ", None),
+        (None, None),
+    ])
+    def test_parse_currency(self, valor, esperado):
+        assert parse_currency(valor) == esperado
 
 
 class TestParseDate:
     """Testes para parse_date."""
     
-    def test_iso_format(self):
-        result = parse_date("2024-01-15")
-        assert result == datetime(2024, 1, 15)
-    
-    def test_pt_format(self):
-        result = parse_date("15/01/2024")
-        assert result == datetime(2024, 1, 15)
-        result = parse_date("15-01-2024")
-        assert result == datetime(2024, 1, 15)
-    
-    def test_invalid(self):
-        assert parse_date("invalid") is None
-        assert parse_date("") is None
-        assert parse_date("   ") is None
-        assert parse_date(None) is None
+    @pytest.mark.parametrize("valor,esperado", [
+        # Formato ISO
+        ("2024-01-15", datetime(2024, 1, 15)),
+        # Formato PT
+        ("15/01/2024", datetime(2024, 1, 15)),
+        ("15-01-2024", datetime(2024, 1, 15)),
+        # Inválidos
+        ("invalid", None),
+        ("", None),
+        ("   ", None),
+        (None, None),
+    ])
+    def test_parse_date(self, valor, esperado):
+        assert parse_date(valor) == esperado
+
+
+
+class TestMakeTempEmail:
+    """Testes para _make_temp_email."""
+    
+    @pytest.mark.parametrize("valor,esperado", [
+        ("Maria Santos", "maria_santos@temp.local"),
+        ("João Conceição", "joao_conceicao@temp.local"),
+        ("Empresa (Lda.) & Filhos", "empresa_lda__filhos@temp.local"),
+        ("", "user@temp.local"),
+        (None, "user@temp.local"),
+    ])
+    def test_make_temp_email(self, valor, esperado):
+        email = _make_temp_email(valor)
+        assert email == esperado
+        assert is_valid_email(email)
 
+class TestTabelasPreCompiladas:
+    """Garante que as regex e tabelas dos normalizadores são montadas uma vez, no módulo."""
+    
+    def test_regex_e_tabela_de_acentos_no_modulo(self):
+        assert isinstance(importer._CURRENCY_RE, re.Pattern)
+        assert isinstance(importer._SEP_RE, re.Pattern)
+        assert isinstance(importer._WS_RE, re.Pattern)
+        assert isinstance(importer._ACCENT_TBL, dict)
@@ -0,0 +1,111 @@
+"""
+Testes da hierarquia de rubricas: recálculo de dotacao_calculada e caminho materializado.
+"""
+import pytest
+from decimal import Decimal
+from sqlalchemy import select, update
+from app.models import Rubrica, TipoRubrica, StatusRubrica
+from app.services.rubrica_service import (
+    get_all_descendants, get_ancestors, recalculate_dotacao_chain,
+    recalculate_dotacao_exercicio
+)
+
+
+def _rubrica(db, codigo, parent_id=None, dotacao_inicial="0.00", status=StatusRubrica.ATIVA):
+    """Cria uma rubrica de 2024 (nível deduzido do código) e faz flush."""
+    rubrica = Rubrica(
+        codigo=codigo,
+        designacao=f"Rubrica {codigo}",
+        tipo=TipoRubrica.DESPESA,
+        parent_id=parent_id,
+        nivel=codigo.count(".") + 1,
+        dotacao_inicial=Decimal(dotacao_inicial),
+        exercicio=2024,
+        status=status
+    )
+    db.add(rubrica)
+    db.flush()
+    return rubrica
+
+
+@pytest.fixture(scope="function")
+def arvore(db):
+    """
+    Cria uma árvore de três níveis no exercício 2024:
+    raiz -> filho (folha_1: 1000, folha_2: 500) e raiz -> inativo (folha, 300).
+    Devolve um dicionário nome -> id.
+    """
+    raiz = _rubrica(db, "8").id
+    filho = _rubrica(db, "8.1", raiz).id
+    return {
+        "raiz": raiz,
+        "filho": filho,
+        "folha_1": _rubrica(db, "8.1.1", filho, "1000.00").id,
+        "folha_2": _rubrica(db, "8.1.2", filho, "500.00").id,
+        "inativo": _rubrica(db, "8.2", raiz, "300.00", StatusRubrica.INATIVA).id,
+    }
+
+
+def _dotacoes(db):
+    """Lê dotacao_calculada de todas as rubricas de 2024 (id -> valor)."""
+    return dict(db.execute(
+        select(Rubrica.id, Rubrica.dotacao_calculada).where(Rubrica.exercicio == 2024)
+    ).all())
+
+
+class TestRecalculateDotacaoExercicio:
+    """Testes do recálculo do exercício numa única passagem."""
+
+    def test_igual_ao_recalculo_por_rubrica(self, db, arvore):
+        """
+        Testa que o recálculo do exercício dá, em cada nó, o mesmo valor que
+        recalculate_dotacao_chain rubrica a rubrica (filhos inativos fora da soma).
+        """
+        recalculate_dotacao_exercicio(db, 2024)
+        por_exercicio = _dotacoes(db)
+
+        assert por_exercicio == {
+            arvore["raiz"]: Decimal("1500.00"),
+            arvore["filho"]: Decimal("1500.00"),
+            arvore["folha_1"]: Decimal("1000.00"),
+            arvore["folha_2"]: Decimal("500.00"),
+            arvore["inativo"]: Decimal("300.00"),
+        }
+
+        db.execute(update(Rubrica).where(Rubrica.exercicio == 2024).values(dotacao_calculada=None))
+        for rubrica_id in arvore.values():
+            recalculate_dotacao_chain(db, rubrica_id)
+        db.flush()
+
+        assert _dotacoes(db) == por_exercicio
+
+
+class TestTraversalIds:
+    """Testes do caminho materializado (traversal_ids) ao mover subárvores."""
+
+    def test_mover_subarvore(self, db):
+        """
+        Testa que mover uma rubrica atualiza o caminho de todos os descendentes
+        (já carregados na sessão) e invalida os caches de ancestrais/descendentes.
+        """
+        topo = _rubrica(db, "7")
+        origem = _rubrica(db, "7.1", topo.id)
+        movida = _rubrica(db, "7.1.1", origem.id)
+        filha = _rubrica(db, "7.1.1.1", movida.id)
+        neta = _rubrica(db, "7.1.1.1.1", filha.id)
+        destino = _rubrica(db, "6")
+        assert neta.traversal_ids == [topo.id, origem.id, movida.id, filha.id]
+
+        # Caches da sessão preenchidos antes da mudança
+        assert {r.id for r in get_all_descendants(db, origem.id)} == {movida.id, filha.id, neta.id}
+        assert get_all_descendants(db, destino.id) == []
+
+        movida.parent_id = destino.id
+        db.flush()
+
+        assert movida.traversal_ids == [destino.id]
+        assert filha.traversal_ids == [destino.id, movida.id]
+        assert neta.traversal_ids == [destino.id, movida.id, filha.id]
+        assert get_all_descendants(db, origem.id) == []
+        assert {r.id for r in get_all_descendants(db, destino.id)} == {movida.id, filha.id, neta.id}
+        assert {r.id for r in get_ancestors(db, neta.id)} == {destino.id, movida.id, filha.id, neta.id}